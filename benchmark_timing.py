@@ -0,0 +1,11 @@
+import time
+
+
+def best_of(function, rounds=3):
+    # (fastest wall time in seconds, result of the last call) over rounds calls of function
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
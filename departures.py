@@ -0,0 +1,130 @@
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from static_db_load import format_gtfs_time
+from timetable_cache import load_timetable, find_index
+
+# Per-date departure indexes kept in memory (today and yesterday cover a live board)
+CACHED_DATES = 4
+
+SECONDS_PER_DAY = 86400
+
+
+def open_departure_board(db_name, timetable_path):
+    # The timetable supplies the stop times, the database the services running on each date
+    return {
+        "conn": sqlite3.connect(db_name, check_same_thread=False),
+        "timetable": load_timetable(timetable_path),
+        "indexes": {},
+    }
+
+
+def active_trip_mask(board, date):
+    # Trips running on a YYYYMMDD date, from the materialised service_days table
+    timetable = board["timetable"]
+    cursor = board["conn"].cursor()
+    cursor.execute("SELECT service_id FROM service_days WHERE date = ?;", (date,))
+    services = [find_index(timetable["service_ids"], row[0]) for row in cursor.fetchall()]
+    active_services = np.zeros(len(timetable["service_ids"]) + 1, dtype=bool)
+    active_services[[service for service in services if service is not None]] = True
+    # trip_service is -1 for trips without a service, which lands on the spare False slot
+    return active_services[timetable["trip_service"]]
+
+
+def departure_index(board, date):
+    # Every stop's departures on a date, sorted by time: the timetable's per-stop event lists
+    # with inactive trips and trip-ending arrivals removed, so a query is a binary search
+    indexes = board["indexes"]
+    if date in indexes:
+        return indexes[date]
+
+    timetable = board["timetable"]
+    events = timetable["stop_events"]
+    event_trips = timetable["st_trip"][events]
+    last_stop = events == timetable["trip_offsets"][event_trips + 1] - 1
+    keep = active_trip_mask(board, date)[event_trips] & ~last_stop
+
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    kept = events[keep]
+    index = {
+        "events": kept,
+        "departures": timetable["st_departure"][kept],
+        "offsets": kept_before[timetable["stop_offsets"]],
+    }
+
+    if len(indexes) >= CACHED_DATES:
+        indexes.pop(next(iter(indexes)))
+    indexes[date] = index
+    return index
+
+
+def departures_after(board, stop, date, seconds, count):
+    index = departure_index(board, date)
+    start, end = index["offsets"][stop], index["offsets"][stop + 1]
+    first = start + int(np.searchsorted(index["departures"][start:end], seconds))
+    last = min(first + count, end)
+    return [(int(departure), int(event), date)
+            for departure, event in zip(index["departures"][first:last], index["events"][first:last])]
+
+
+def next_departures(board, stop_id, date, seconds, count=10):
+    # The next count departures from stop_id at or after seconds past midnight on a YYYYMMDD
+    # date, including previous-day trips running past midnight (e.g. 25:10:00)
+    timetable = board["timetable"]
+    stop = find_index(timetable["stop_ids"], stop_id)
+    if stop is None:
+        return []
+
+    previous_date = (datetime.strptime(date, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d')
+    candidates = departures_after(board, stop, date, seconds, count)
+    candidates += [(departure - SECONDS_PER_DAY, event, service_date) for departure, event, service_date
+                   in departures_after(board, stop, previous_date, seconds + SECONDS_PER_DAY, count)]
+    candidates.sort()
+
+    results = []
+    for departure, event, service_date in candidates[:count]:
+        trip = timetable["st_trip"][event]
+        route = timetable["trip_route"][trip]
+        results.append({
+            "departure_time": format_gtfs_time(departure),
+            "trip_id": timetable["trip_ids"][trip].decode(),
+            "route_short_name": timetable["route_short_names"][route].decode() if route >= 0 else None,
+            "service_date": service_date,
+        })
+    return results
+
+
+def benchmark(board, date=None, queries=10000, count=10):
+    # Latency of random stop/time queries, once the date's index is built
+    date = date or datetime.now().strftime('%Y%m%d')
+    stop_ids = [stop_id.decode() for stop_id in board["timetable"]["stop_ids"]]
+
+    start = time.perf_counter()
+    departure_index(board, date)
+    departure_index(board, (datetime.strptime(date, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d'))
+    print(f"Built departure indexes for {date} and the day before in {time.perf_counter() - start:.2f}s.")
+
+    latencies = []
+    for _ in range(queries):
+        stop_id = random.choice(stop_ids)
+        seconds = random.randrange(SECONDS_PER_DAY)
+        start = time.perf_counter_ns()
+        next_departures(board, stop_id, date, seconds, count)
+        latencies.append(time.perf_counter_ns() - start)
+
+    latencies = np.array(latencies) / 1000
+    print(f"{queries} next-departure queries: p50 {np.percentile(latencies, 50):.1f}us, "
+          f"p99 {np.percentile(latencies, 99):.1f}us, max {latencies.max():.1f}us.")
+    return latencies
+
+
+if __name__ == "__main__":
+    db_name = sys.argv[1]
+    timetable_path = sys.argv[2] if len(sys.argv) > 2 else f"{db_name}.timetable"
+    board = open_departure_board(db_name, timetable_path)
+    benchmark(board)
@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+
+# Quantile sketches keep counts in logarithmic buckets (as DDSketch): any quantile is returned
+# within RELATIVE_ACCURACY of a value of that rank, and sketches merge by adding bucket counts.
+# Memory is bounded by the range of the values rather than how many there are, and capped at
+# MAX_BUCKETS per sign by folding the buckets nearest zero together.
+RELATIVE_ACCURACY = 0.001
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MAX_BUCKETS = 4096
+
+# Magnitudes below this are counted as zero
+MIN_VALUE = 1e-9
+
+
+def new_sketch():
+    return {"count": 0, "sum": 0.0, "zero": 0, "positive": {}, "negative": {}}
+
+
+def add_to_store(store, indexes, sign=1):
+    keys, counts = np.unique(indexes, return_counts=True)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        store[key] = store.get(key, 0) + sign * count
+    if len(store) > MAX_BUCKETS:
+        ordered = sorted(store)
+        folded = ordered[len(ordered) - MAX_BUCKETS]
+        store[folded] += sum(store.pop(key) for key in ordered[:len(ordered) - MAX_BUCKETS])
+
+
+def add_values(sketch, values):
+    # Add a whole batch of values (array-like) at once
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return sketch
+    sketch["count"] += len(values)
+    sketch["sum"] += float(values.sum())
+    magnitudes = np.abs(values)
+    small = magnitudes < MIN_VALUE
+    sketch["zero"] += int(small.sum())
+    indexes = np.ceil(np.log(np.where(small, 1.0, magnitudes)) / LOG_GAMMA).astype(np.int64)
+    for name, mask in (("positive", (values > 0) & ~small), ("negative", (values < 0) & ~small)):
+        if mask.any():
+            add_to_store(sketch[name], indexes[mask])
+    return sketch
+
+
+def merge_sketch(total, sketch, sign=1):
+    # Add one sketch into another (in place); sign=-1 takes it back out. Keys may be strings
+    # when the sketch was read back from JSON.
+    total["count"] += sign * sketch["count"]
+    total["sum"] += sign * sketch["sum"]
+    total["zero"] += sign * sketch["zero"]
+    for name in ("positive", "negative"):
+        store = total[name]
+        for key, count in sketch[name].items():
+            key = int(key)
+            store[key] = store.get(key, 0) + sign * count
+            if not store[key]:
+                del store[key]
+    return total
+
+
+def bucket_value(index):
+    # The value a bucket stands for: within RELATIVE_ACCURACY of everything counted in it
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+def sketch_quantiles(sketch, quantiles=(0.05, 0.5, 0.95, 0.99)):
+    # {quantile: value}, empty for an empty sketch
+    if sketch["count"] <= 0:
+        return {}
+    buckets = [(-bucket_value(int(key)), count) for key, count in sorted(sketch["negative"].items(),
+                                                                          key=lambda item: -int(item[0]))]
+    buckets.append((0.0, sketch["zero"]))
+    buckets.extend((bucket_value(int(key)), count) for key, count in sorted(sketch["positive"].items(),
+                                                                           key=lambda item: int(item[0])))
+    values = np.array([value for value, count in buckets if count > 0])
+    cumulative = np.cumsum([count for _, count in buckets if count > 0])
+    ranks = np.array(quantiles) * (cumulative[-1] - 1)
+    return {quantile: float(value) for quantile, value in
+            zip(quantiles, values[np.searchsorted(cumulative, ranks, side='right')])}
+
+
+def new_histogram(low, high, bins):
+    return {"low": low, "high": high, "counts": [0] * bins, "under": 0, "over": 0}
+
+
+def add_histogram(histogram, values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    low, high = histogram["low"], histogram["high"]
+    counts, _ = np.histogram(values, bins=len(histogram["counts"]), range=(low, high))
+    histogram["counts"] = (np.array(histogram["counts"]) + counts).tolist()
+    histogram["under"] += int((values < low).sum())
+    histogram["over"] += int((values > high).sum())
+    return histogram
+
+
+def merge_histogram(total, histogram, sign=1):
+    total["counts"] = [a + sign * b for a, b in zip(total["counts"], histogram["counts"])]
+    total["under"] += sign * histogram["under"]
+    total["over"] += sign * histogram["over"]
+    return total
+
+
+def histogram_labels(histogram):
+    edges = np.linspace(histogram["low"], histogram["high"], len(histogram["counts"]) + 1)
+    return [f"{edge:g}" for edge in edges[:-1]]
@@ -1,4 +1,29 @@
+import math
+import mmap
+import os
+import random
+import sys
+
+import numpy as np
+
 import gtfs_realtime_pb2
+from benchmark_timing import best_of
+from gtfs_rt_wire import (ENTITY_TYPE_NAMES, FEED_ENTITY, WIRE_LENGTH_DELIMITED, entity_type, open_feed, parse_entity,
+                          read_varint, skip_field)
+
+# Entities of each type sampled by the census
+SAMPLE_SIZE = 3
+
+ENTITY_KEY = FEED_ENTITY << 3 | WIRE_LENGTH_DELIMITED
+ENTITY_ID_KEY = 1 << 3 | WIRE_LENGTH_DELIMITED
+
+# Payload field number of each one-byte tag that opens an entity payload, 0 for any other byte
+PAYLOAD_KEYS = np.array([key >> 3 if key < 0x80 and key & 0x7 == WIRE_LENGTH_DELIMITED and key >> 3 in ENTITY_TYPE_NAMES
+                         else 0 for key in range(256)], dtype=np.int64)
+
+# The feed is scanned this many bytes at a time, bounding the scan's working memory
+CHUNK_BYTES = 1 << 18
+
 
 def print_entity_details(entity):
     for field in entity.DESCRIPTOR.fields:
@@ -22,22 +47,199 @@ def print_top_three(entities, entity_type):
         print_entity_details(entity)
         print()  # Add a new line for better readability
 
-# Load and parse the GTFS Real-Time data
-feed = gtfs_realtime_pb2.FeedMessage()
-with open('gtfsrt.bin', 'rb') as f:
-    feed.ParseFromString(f.read())
-
-# Separating different types of data
-trip_updates = [entity.trip_update for entity in feed.entity if entity.HasField('trip_update')]
-vehicle_positions = [entity.vehicle for entity in feed.entity if entity.HasField('vehicle')]
-service_alerts = [entity.alert for entity in feed.entity if entity.HasField('alert')]
-
-# Count and print the results
-print(f"Total Trip Updates: {len(trip_updates)}")
-print(f"Total Vehicle Positions: {len(vehicle_positions)}")
-print(f"Total Service Alerts: {len(service_alerts)}")
-
-# Print the top 3 of each type
-print_top_three(trip_updates, "Trip Updates")
-print_top_three(vehicle_positions, "Vehicle Positions")
-print_top_three(service_alerts, "Service Alerts")
+
+def top_three(file_path):
+    # Load and parse the GTFS Real-Time data
+    feed = gtfs_realtime_pb2.FeedMessage()
+    with open(file_path, 'rb') as f:
+        feed.ParseFromString(f.read())
+
+    # Separating different types of data
+    trip_updates = [entity.trip_update for entity in feed.entity if entity.HasField('trip_update')]
+    vehicle_positions = [entity.vehicle for entity in feed.entity if entity.HasField('vehicle')]
+    service_alerts = [entity.alert for entity in feed.entity if entity.HasField('alert')]
+
+    # Count and print the results
+    print(f"Total Trip Updates: {len(trip_updates)}")
+    print(f"Total Vehicle Positions: {len(vehicle_positions)}")
+    print(f"Total Service Alerts: {len(service_alerts)}")
+
+    # Print the top 3 of each type
+    print_top_three(trip_updates, "Trip Updates")
+    print_top_three(vehicle_positions, "Vehicle Positions")
+    print_top_three(service_alerts, "Service Alerts")
+
+
+def random_unit(rng):
+    # Uniform on (0, 1), safe to take the log of
+    return rng.random() or 0.5
+
+
+def skip_count(rng, weight):
+    return int(math.log(random_unit(rng)) / math.log1p(-weight)) if weight < 1 else 0
+
+
+def offer(reservoir, index, item, rng):
+    # Reservoir sampling by Algorithm L: the reservoir is offered only the items it keeps, and
+    # returns the index of the next one, so the items in between cost nothing beyond being counted
+    items, size = reservoir["items"], reservoir["size"]
+    if index < size:
+        items.append(item)
+        if index + 1 < size:
+            return index + 1
+        reservoir["weight"] = math.exp(math.log(random_unit(rng)) / size)
+        return size + skip_count(rng, reservoir["weight"])
+    items[rng.randrange(size)] = item
+    reservoir["weight"] *= math.exp(math.log(random_unit(rng)) / size)
+    return index + 1 + skip_count(rng, reservoir["weight"])
+
+
+def entity_candidates(view, lo, hi):
+    # (start, body, end) arrays for the bytes in view[lo:hi] that look like the start of an
+    # entity under 16 KB beginning with its id: the entity tag, a one or two byte length, then
+    # the id tag. Anything else (the header, a longer entity, one without a leading id) is left
+    # to the field-by-field scan, and a lookalike inside an entity is never reached by the chain.
+    window = view[lo:hi + 3]
+    if len(window) < hi - lo + 3:
+        window = np.concatenate([window, np.zeros(hi - lo + 3 - len(window), dtype=np.uint8)])
+    # Whole-chunk comparisons narrow it down to a tag byte with an id tag two or three bytes
+    # on, which few bytes inside entities have; only those are gathered and checked further
+    id_keys = window[2:] == ENTITY_ID_KEY
+    starts = np.flatnonzero((window[:hi - lo] == ENTITY_KEY) & (id_keys[:hi - lo] | id_keys[1:hi - lo + 1]))
+    first, second, third = window[starts + 1], window[starts + 2], window[starts + 3]
+    short = first < 0x80
+    found = (short & (second == ENTITY_ID_KEY)) | (~short & (second < 0x80) & (third == ENTITY_ID_KEY))
+    starts, short = starts[found], short[found]
+    first, second = first[found].astype(np.int64), second[found].astype(np.int64)
+    bodies = starts + np.where(short, 2, 3)
+    ends = bodies + np.where(short, first, (first & 0x7F) | second << 7)
+    return starts + lo, bodies + lo, ends + lo
+
+
+def payload_types(view, data, bodies, ends):
+    # Payload field number of each entity. Entities start with their id in practice, so the
+    # payload tag is usually the byte straight after it; anything else gets the general
+    # field-by-field scan.
+    last = len(view) - 1
+    id_lengths = view[np.minimum(bodies + 1, last)].astype(np.int64)
+    payload_tags = bodies + 2 + id_lengths
+    found = (ends - bodies > 2) & (view[np.minimum(bodies, last)] == ENTITY_ID_KEY) & (id_lengths < 0x80) & \
+        (payload_tags < ends)
+    payloads = np.where(found, PAYLOAD_KEYS[view[np.minimum(payload_tags, last)]], 0)
+    for i in np.flatnonzero(payloads == 0).tolist():
+        payloads[i] = entity_type(data, int(bodies[i]), int(ends[i]))
+    return payloads
+
+
+def census(data, sample_size=SAMPLE_SIZE, seed=None):
+    # {entity type: (count, [(start, end) of a uniform random sample of sample_size entities])}
+    # for a serialised FeedMessage (bytes or an mmap), from the field tags alone. Entities are
+    # counted by payload type without being decoded; type '' is an entity with no payload.
+    # Candidate entities are found a chunk at a time with numpy. Python only follows the chain
+    # of fields from one run of back-to-back entities to the next (a run breaks at the header,
+    # an unusual entity or a lookalike byte inside one); each chunk's entities are then
+    # classified and counted in one go.
+    rng = random.Random(seed)
+    counts = [0] * (max(ENTITY_TYPE_NAMES) + 1)
+    next_sample = [0 if sample_size else math.inf] * len(counts)
+    reservoirs = [{"size": sample_size, "items": []} for _ in counts]
+    view = np.frombuffer(data, dtype=np.uint8)
+    pos = 0
+    size = len(data)
+    while pos < size:
+        lo, hi = pos, min(size, pos + CHUNK_BYTES)
+        starts, bodies, ends = entity_candidates(view, lo, hi)
+        # Index of the last candidate of the run each candidate is in
+        breaks = np.append(np.flatnonzero(ends[:-1] != starts[1:]), len(starts) - 1)
+        chunk_bodies, chunk_ends = [], []
+        while pos < hi:
+            i = int(np.searchsorted(starts, pos))
+            if i < len(starts) and starts[i] == pos:
+                last = int(breaks[np.searchsorted(breaks, i)])
+                chunk_bodies.append(bodies[i:last + 1])
+                chunk_ends.append(ends[i:last + 1])
+                pos = int(ends[last])
+                continue
+            key, pos = read_varint(data, pos)
+            if key != ENTITY_KEY:
+                pos = skip_field(data, pos, key & 0x7)
+                continue
+            length, body = read_varint(data, pos)
+            pos = body + length
+            chunk_bodies.append(np.array([body]))
+            chunk_ends.append(np.array([pos]))
+        if not chunk_bodies:
+            continue
+
+        chunk_bodies, chunk_ends = np.concatenate(chunk_bodies), np.concatenate(chunk_ends)
+        payloads = payload_types(view, data, chunk_bodies, chunk_ends)
+        for payload, count in enumerate(np.bincount(payloads, minlength=len(counts)).tolist()):
+            first = counts[payload]
+            counts[payload] = first + count
+            if next_sample[payload] >= counts[payload]:
+                continue
+            members = np.flatnonzero(payloads == payload)
+            while next_sample[payload] < counts[payload]:
+                member = members[next_sample[payload] - first]
+                span = (int(chunk_bodies[member]), int(chunk_ends[member]))
+                next_sample[payload] = offer(reservoirs[payload], next_sample[payload], span, rng)
+    del view
+    return {ENTITY_TYPE_NAMES.get(payload, ''): (count, reservoirs[payload]["items"])
+            for payload, count in enumerate(counts) if count}
+
+
+def census_file(file_path, sample_size=SAMPLE_SIZE, seed=None):
+    with open_feed(file_path) as data:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        results = census(data, sample_size, seed)
+        # Only the sampled entities are decoded
+        return {name: (count, [parse_entity(data, start, end) for start, end in sorted(spans)])
+                for name, (count, spans) in results.items()}
+
+
+def print_census(file_path, sample_size=SAMPLE_SIZE, seed=None):
+    results = census_file(file_path, sample_size, seed)
+    for name, (count, _) in results.items():
+        print(f"Total {name or 'empty'} entities: {count}")
+    for name, (count, entities) in results.items():
+        if not name:
+            continue
+        print(f"Random sample of {len(entities)} of {count} {name} entities:")
+        for entity in entities:
+            print_entity_details(getattr(entity, name))
+            print()
+
+
+def benchmark(file_path, rounds=3):
+    # Census throughput against reading the file and against the full parse it replaces
+    size = os.path.getsize(file_path)
+
+    def read():
+        with open(file_path, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+
+    def parse():
+        feed = gtfs_realtime_pb2.FeedMessage()
+        with open(file_path, 'rb') as f:
+            feed.ParseFromString(f.read())
+        return [entity for entity in feed.entity if entity.HasField('vehicle')]
+
+    print(f"{file_path}: {size / 1e6:.1f} MB")
+    for name, function in (("read", read), ("census", lambda: census_file(file_path)), ("ParseFromString", parse)):
+        best, _ = best_of(function, rounds)
+        print(f"  {name}: {best:.3f}s ({size / 1e6 / best:,.0f} MB/s)")
+
+
+if __name__ == "__main__":
+    # python entity_counts_top3.py [gtfsrt.bin]
+    # python entity_counts_top3.py census gtfsrt.bin [sample size] [seed]
+    # python entity_counts_top3.py benchmark gtfsrt.bin
+    if len(sys.argv) > 2 and sys.argv[1] == 'census':
+        print_census(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else SAMPLE_SIZE,
+                     int(sys.argv[4]) if len(sys.argv) > 4 else None)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'benchmark':
+        benchmark(sys.argv[2])
+    else:
+        top_three(sys.argv[1] if len(sys.argv) > 1 else 'gtfsrt.bin')
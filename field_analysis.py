@@ -0,0 +1,481 @@
+import json
+import sys
+from collections import Counter
+
+import numpy as np
+from google.protobuf.descriptor import FieldDescriptor
+
+import gtfs_realtime_pb2
+from benchmark_timing import best_of
+from distribution_sketch import (add_histogram, add_values, histogram_labels, merge_histogram, merge_sketch,
+                                 new_histogram, new_sketch, sketch_quantiles)
+from gtfs_rt_wire import ENTITY_TYPES, iter_entities, open_feed, read_feed_header
+
+# Actions in a compiled analysis plan
+PRESENCE = 0
+VALUES = 1
+MESSAGE = 2
+REPEATED_MESSAGE = 3
+NUMERIC = 4
+FEED_TIMESTAMP = 5
+
+# Integer fields whose values are too varied to be worth counting
+EXCLUDE_UNIQUE_COUNT = {'current_stop_sequence', 'stop_sequence', 'timestamp', 'time', 'start', 'end', 'delay',
+                        'uncertainty'}
+
+VALUE_TYPES = {
+    FieldDescriptor.CPPTYPE_INT32, FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT32,
+    FieldDescriptor.CPPTYPE_UINT64, FieldDescriptor.CPPTYPE_ENUM, FieldDescriptor.CPPTYPE_BOOL,
+}
+
+# Numeric fields whose values aren't counted one by one get a quantile sketch instead - except
+# absolute times, whose useful distribution is how far they lag the feed header (feed_lag)
+NUMERIC_TYPES = {
+    FieldDescriptor.CPPTYPE_INT32, FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT32,
+    FieldDescriptor.CPPTYPE_UINT64, FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE,
+}
+TIME_FIELDS = {'timestamp', 'time', 'start', 'end'}
+FEED_LAG = 'feed_lag'
+
+# Fixed-bin histograms (low, high, bins) by field path, for the report
+HISTOGRAM_BINS = {
+    'position.latitude': (49.0, 61.0, 48),
+    'position.longitude': (-9.0, 3.0, 48),
+    'position.bearing': (0.0, 360.0, 36),
+    'position.speed': (0.0, 40.0, 40),
+    'delay': (-900.0, 1800.0, 45),
+    'stop_time_update[].arrival.delay': (-900.0, 1800.0, 45),
+    'stop_time_update[].departure.delay': (-900.0, 1800.0, 45),
+    FEED_LAG: (-60.0, 600.0, 44),
+}
+
+# Numeric values are buffered and added to their sketches this many entities at a time, so
+# memory stays flat however large the snapshot or however many are analysed
+BATCH_SIZE = 50000
+
+
+def compile_analyzer(descriptor):
+    # Walk a message descriptor once and return (fields, plan). fields maps each dotted field
+    # path (trip.route_id; elements of repeated messages as stop_time_update[].arrival.delay)
+    # to its counters [present, value Counter or None, enum names or None, scope, numeric buffer
+    # or None, distribution or None]; plan maps field number -> (action, counters, nested plan)
+    # for the visit. A field's scope counts the messages it could have appeared in: the entity,
+    # or the elements of a repeated field. An entity's own timestamp feeds the feed_lag entry.
+    fields = {}
+    root = [0]
+    lag = [0, None, None, root, [], new_distribution(FEED_LAG)]
+
+    def compile_message(descriptor, prefix, scope):
+        plan = {}
+        for field in descriptor.fields:
+            path = f"{prefix}{field.name}"
+            counters = [0, None, None, scope, None, None]
+            fields[path] = counters
+            if field.type == field.TYPE_MESSAGE and field.label == field.LABEL_REPEATED:
+                element_scope = [0]
+                plan[field.number] = (REPEATED_MESSAGE, counters,
+                                      (compile_message(field.message_type, path + '[].', element_scope), element_scope))
+            elif field.type == field.TYPE_MESSAGE:
+                plan[field.number] = (MESSAGE, counters, compile_message(field.message_type, path + '.', scope))
+            elif field.cpp_type in VALUE_TYPES and field.label != field.LABEL_REPEATED \
+                    and field.name not in EXCLUDE_UNIQUE_COUNT:
+                counters[1] = Counter()
+                if field.enum_type is not None:
+                    counters[2] = {value.number: value.name for value in field.enum_type.values}
+                plan[field.number] = (VALUES, counters, None)
+            elif path == 'timestamp':
+                plan[field.number] = (FEED_TIMESTAMP, counters, lag)
+            elif field.cpp_type in NUMERIC_TYPES and field.label != field.LABEL_REPEATED \
+                    and field.name not in TIME_FIELDS:
+                counters[4] = []
+                counters[5] = new_distribution(path)
+                plan[field.number] = (NUMERIC, counters, None)
+            else:
+                plan[field.number] = (PRESENCE, counters, None)
+        return plan
+
+    plan = compile_message(descriptor, '', root)
+    if 'timestamp' in fields:
+        fields[FEED_LAG] = lag
+    return fields, plan, root
+
+
+def new_distribution(path):
+    bins = HISTOGRAM_BINS.get(path)
+    return {"sketch": new_sketch(), "histogram": new_histogram(*bins) if bins else None}
+
+
+def add_distribution(distribution, values):
+    add_values(distribution["sketch"], values)
+    if distribution["histogram"] is not None:
+        add_histogram(distribution["histogram"], values)
+
+
+def visit(message, plan):
+    # Only fields that are set are visited, so discovering fields and counting them is one pass
+    for field, value in message.ListFields():
+        action, counters, nested = plan[field.number]
+        counters[0] += 1
+        if action == VALUES:
+            counters[1][value] += 1
+        elif action == NUMERIC:
+            counters[4].append(value)
+        elif action == FEED_TIMESTAMP:
+            nested[4].append(value)
+        elif action == MESSAGE:
+            visit(value, nested)
+        elif action == REPEATED_MESSAGE:
+            element_plan, element_scope = nested
+            element_scope[0] += len(value)
+            for element in value:
+                visit(element, element_plan)
+
+
+def new_analysis(types=None):
+    # A compiled analyzer per entity payload type (vehicle, trip_update, alert, ...)
+    types = types or list(ENTITY_TYPES)
+    descriptor = gtfs_realtime_pb2.FeedEntity.DESCRIPTOR
+    return {descriptor.fields_by_name[name].number: (name, compile_analyzer(descriptor.fields_by_name[name].message_type))
+            for name in types}
+
+
+def flush_numbers(analysis, feed_timestamp=None):
+    # Add the buffered numeric values to their sketches and histograms, one array per field.
+    # Entity timestamps become feed_lag (header timestamp - entity timestamp) where the feed
+    # timestamp is known.
+    for _, (fields, _, _) in analysis.values():
+        for path, counters in fields.items():
+            numbers = counters[4]
+            if not numbers:
+                continue
+            values = np.array(numbers, dtype=np.float64)
+            numbers.clear()
+            if path == FEED_LAG:
+                if not feed_timestamp:
+                    continue
+                values = feed_timestamp - values
+                counters[0] += len(values)
+            add_distribution(counters[5], values)
+
+
+def analyze_entities(entities, analysis=None, feed_timestamp=None):
+    # Count field presence and values, and profile numeric fields, over FeedEntity messages in
+    # a single pass
+    analysis = analysis or new_analysis()
+    for i, entity in enumerate(entities, 1):
+        for field, value in entity.ListFields():
+            analyzer = analysis.get(field.number)
+            if analyzer is not None:
+                _, (_, plan, root) = analyzer
+                root[0] += 1
+                visit(value, plan)
+        if i % BATCH_SIZE == 0:
+            flush_numbers(analysis, feed_timestamp)
+    flush_numbers(analysis, feed_timestamp)
+    return analysis
+
+
+def analyze_feed(data, analysis=None):
+    # analyze_entities over a serialised feed (bytes or an mmap), with feed lag from its header
+    header = read_feed_header(data)
+    return analyze_entities(iter_entities(data), analysis, header.timestamp if header else None)
+
+
+def analysis_counts(analysis):
+    # {entity type: {"count": entities, "enums": [paths], "fields": {path: {"present", "absent",
+    # "unique_values"}}}} for every field that could have occurred, including those that never
+    # did - the form partial analyses are merged in
+    counts = {}
+    for name, (fields, _, root) in analysis.values():
+        if not root[0]:
+            continue
+        used = {}
+        for path, (present, values, names, scope, _, distribution) in fields.items():
+            if not scope[0]:
+                continue
+            unique_values = {}
+            if values:
+                unique_values = {(names.get(value, value) if names else value): count for value, count in values.items()}
+            used[path] = {"present": present, "absent": scope[0] - present, "unique_values": unique_values}
+            if distribution is not None:
+                used[path]["distribution"] = distribution
+        counts[name] = {"count": root[0], "enums": [path for path, counters in fields.items() if counters[2]],
+                        "fields": used}
+    return counts
+
+
+def typed_value(value):
+    # A unique value as analysis_counts keys it. Read back from JSON, int and bool keys come back
+    # as strings; only enum names are strings to begin with, and those are never 'true', 'false'
+    # or a number.
+    if not isinstance(value, str):
+        return value
+    if value in ('true', 'false'):
+        return value == 'true'
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def merge_counts(total, counts, sign=1):
+    # Add one analysis_counts into another (in place) and return it; sign=-1 takes it back out.
+    # Counts may have been read back from JSON.
+    for name, result in counts.items():
+        merged = total.setdefault(name, {"count": 0, "enums": result["enums"], "fields": {}})
+        merged["count"] += sign * result["count"]
+        for path, data in result["fields"].items():
+            field = merged["fields"].setdefault(path, {"present": 0, "absent": 0, "unique_values": {}})
+            field["present"] += sign * data["present"]
+            field["absent"] += sign * data["absent"]
+            unique_values = field["unique_values"]
+            for value, count in data["unique_values"].items():
+                value = typed_value(value)
+                unique_values[value] = unique_values.get(value, 0) + sign * count
+            if "distribution" in data:
+                histogram = data["distribution"]["histogram"]
+                distribution = field.setdefault("distribution", {
+                    "sketch": new_sketch(),
+                    "histogram": new_histogram(histogram["low"], histogram["high"], len(histogram["counts"]))
+                    if histogram else None})
+                merge_sketch(distribution["sketch"], data["distribution"]["sketch"], sign)
+                if histogram and distribution["histogram"]:
+                    merge_histogram(distribution["histogram"], histogram, sign)
+    return total
+
+
+def used_fields(counts):
+    # analysis_counts narrowed to the fields that occurred, most common values first
+    results = {}
+    for name, result in counts.items():
+        fields = {path: {**data, "unique_values": dict(sorted(data["unique_values"].items(), key=lambda item: -item[1]))}
+                  for path, data in result["fields"].items() if data["present"]}
+        results[name] = {"count": result["count"], "enums": result["enums"], "fields": fields}
+    return results
+
+
+def analysis_results(analysis):
+    return used_fields(analysis_counts(analysis))
+
+
+def analyze_file(path):
+    # (path, analysis_counts) of one .bin snapshot - the unit of work for field_analysis_archive
+    with open_feed(path) as data:
+        return path, analysis_counts(analyze_feed(data))
+
+
+def print_results(results):
+    for name, result in results.items():
+        print(f"Fields used in {result['count']} {name} entities:")
+        for path, data in result["fields"].items():
+            print(f"Field: {path}")
+            print(f"  Present: {data['present']}")
+            print(f"  Absent: {data['absent']}")
+            if data["unique_values"]:
+                print(f"  Unique Values: {data['unique_values']}")
+            quantiles = distribution_quantiles(data)
+            if quantiles:
+                print(f"  Quantiles: {', '.join(f'p{q * 100:g}: {value:.6g}' for q, value in quantiles.items())}")
+        print()
+
+
+def distribution_quantiles(data):
+    if "distribution" not in data:
+        return {}
+    return sketch_quantiles(data["distribution"]["sketch"])
+
+
+def chart_data(results):
+    chart_data = {}
+    for name, result in results.items():
+        for path, data in result["fields"].items():
+            if path in result["enums"]:
+                # Enumerated field: use unique values for the pie chart
+                counts = data["unique_values"]
+            else:
+                # Non-enumerated field: use present and absent counts
+                counts = {"Present": data["present"], "Absent": data["absent"]}
+            chart_data[f"{name}.{path}"] = {"labels": list(counts.keys()), "data": list(counts.values()), "counts": counts}
+    return chart_data
+
+
+def histogram_data(results):
+    histograms = {}
+    for name, result in results.items():
+        for path, data in result["fields"].items():
+            histogram = data.get("distribution", {}).get("histogram")
+            if histogram and sum(histogram["counts"]):
+                histograms[f"{name}.{path}"] = {"labels": histogram_labels(histogram), "data": histogram["counts"],
+                                                "under": histogram["under"], "over": histogram["over"]}
+    return histograms
+
+
+def distribution_table(results):
+    # Count, mean and quantiles of every profiled numeric field
+    rows = []
+    for name, result in results.items():
+        for path, data in result["fields"].items():
+            sketch = data.get("distribution", {}).get("sketch")
+            if not sketch or sketch["count"] <= 0:
+                continue
+            quantiles = sketch_quantiles(sketch)
+            cells = [f"{name}.{path}", sketch["count"], f"{sketch['sum'] / sketch['count']:.6g}"] + \
+                    [f"{value:.6g}" for value in quantiles.values()]
+            rows.append('<tr>' + ''.join(f'<td>{cell}</td>' for cell in cells) + '</tr>')
+    if not rows:
+        return ''
+    return f"""<h2>Numeric Fields</h2>
+    <table border="1" style="border-collapse: collapse;">
+        <tr><th>Field</th><th>Count</th><th>Mean</th><th>p5</th><th>p50</th><th>p95</th><th>p99</th></tr>
+        {''.join(rows)}
+    </table>"""
+
+
+def write_report(results, title, filename, extra_html=''):
+    charts = chart_data(results)
+    histograms = histogram_data(results)
+    fields_present = ''.join(f"<h3>{name} ({result['count']})</h3><ul>{''.join(f'<li>{path}</li>' for path in result['fields'])}</ul>"
+                             for name, result in results.items())
+    html_content = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>{title}</title>
+    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+    <style>
+        .chart-container {{
+            display: inline-block;
+            width: 300px; /* Adjust the width as needed */
+        }}
+        .chart-title {{
+            text-align: center;
+        }}
+    </style>
+</head>
+<body>
+    <h1>GTFS Analysis Report: {title}</h1>
+    <h2>Fields Present</h2>
+    {fields_present}
+    <h2>Field Analysis</h2>
+    <div style="display: flex; flex-wrap: wrap;">
+        {''.join([f'<div class="chart-container"><h3 class="chart-title">{field} ({", ".join([f"{k}: {v}" for k, v in charts[field]["counts"].items()])})</h3><canvas id="{field}_chart"></canvas></div>' for field in charts.keys()])}
+    </div>
+    {distribution_table(results)}
+    <div style="display: flex; flex-wrap: wrap;">
+        {''.join([f'<div class="chart-container"><h3 class="chart-title">{field} (below: {data["under"]}, above: {data["over"]})</h3><canvas id="{field}_histogram"></canvas></div>' for field, data in histograms.items()])}
+    </div>
+    {extra_html}
+    <script>
+        const chartData = {json.dumps(charts)};
+        const histogramData = {json.dumps(histograms)};
+        window.onload = function() {{
+            for (const [field, data] of Object.entries(histogramData)) {{
+                const ctx = document.getElementById(field + '_histogram').getContext('2d');
+                new Chart(ctx, {{
+                    type: 'bar',
+                    data: {{
+                        labels: data.labels,
+                        datasets: [{{label: field, data: data.data, backgroundColor: 'blue'}}]
+                    }}
+                }});
+            }}
+            for (const [field, data] of Object.entries(chartData)) {{
+                const ctx = document.getElementById(field + '_chart').getContext('2d');
+                new Chart(ctx, {{
+                    type: 'pie',
+                    data: {{
+                        labels: data.labels,
+                        datasets: [{{
+                            data: data.data,
+                            backgroundColor: ['green', 'red', 'blue', 'yellow', 'purple', 'orange'] // Add more colors if needed
+                        }}]
+                    }}
+                }});
+            }}
+        }};
+    </script>
+</body>
+</html>
+"""
+    with open(filename, "w") as file:
+        file.write(html_content)
+    print(f"Report generated: {filename}")
+
+
+def list_all_fields_reflective(vehicle_positions):
+    # The per-script list_all_fields and analyze_vehicle_positions this module replaces, kept
+    # as the benchmark baseline
+    all_fields = set()
+    for vehicle in vehicle_positions:
+        for field in vehicle.DESCRIPTOR.fields:
+            try:
+                if vehicle.HasField(field.name):
+                    all_fields.add(field.name)
+            except ValueError:
+                if getattr(vehicle, field.name):
+                    all_fields.add(field.name)
+        if vehicle.HasField('trip'):
+            for field in vehicle.trip.DESCRIPTOR.fields:
+                try:
+                    if vehicle.trip.HasField(field.name):
+                        all_fields.add(f"trip.{field.name}")
+                except ValueError:
+                    if getattr(vehicle.trip, field.name):
+                        all_fields.add(f"trip.{field.name}")
+    return all_fields
+
+
+def analyze_vehicle_positions_reflective(vehicle_positions, fields_to_analyze, enum_fields, exclude_unique_count):
+    summary = {field: {"present": 0, "absent": 0, "unique_values": {}} for field in fields_to_analyze}
+    for vehicle in vehicle_positions:
+        for field in fields_to_analyze:
+            is_nested = '.' in field
+            field_parts = field.split('.') if is_nested else [field]
+            field_obj = vehicle
+            for part in field_parts:
+                field_obj = getattr(field_obj, part, None)
+                if field_obj is None:
+                    break
+            if field_obj is not None and not (isinstance(field_obj, str) and field_obj == ""):
+                summary[field]["present"] += 1
+                if field not in exclude_unique_count and isinstance(field_obj, int):
+                    enum_value = field_obj
+                    if field in enum_fields:
+                        enum_value = enum_fields[field].Name(field_obj)
+                    summary[field]["unique_values"][enum_value] = summary[field]["unique_values"].get(enum_value, 0) + 1
+            else:
+                summary[field]["absent"] += 1
+    return summary
+
+
+def benchmark(file_path=None, entities=25000, rounds=3):
+    # Time to analyse a feed's vehicles (by default a synthetic 25,000 vehicle snapshot) with
+    # the old two-pass reflective code against one compiled pass over every entity type
+    if file_path:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    else:
+        from gtfs_rt_fetcher import make_mock_feed
+        data = make_mock_feed(entities)
+    feed_entities = list(iter_entities(data))
+    vehicle_positions = [entity.vehicle for entity in feed_entities if entity.HasField('vehicle')]
+    enum_fields = {
+        'current_status': gtfs_realtime_pb2.VehiclePosition.VehicleStopStatus,
+        'occupancy_status': gtfs_realtime_pb2.VehiclePosition.OccupancyStatus,
+        'trip.schedule_relationship': gtfs_realtime_pb2.TripDescriptor.ScheduleRelationship
+    }
+
+    def reflective():
+        fields_used = list_all_fields_reflective(vehicle_positions)
+        return analyze_vehicle_positions_reflective(vehicle_positions, list(fields_used), enum_fields,
+                                                    ['current_stop_sequence', 'timestamp'])
+
+    for name, analyze in (("reflective, vehicles only", reflective),
+                          ("compiled, vehicles only", lambda: analyze_entities(feed_entities, new_analysis(['vehicle']))),
+                          ("compiled, all entity types", lambda: analyze_entities(feed_entities))):
+        best, _ = best_of(analyze, rounds)
+        print(f"{name}: {len(feed_entities)} entities in {best:.3f}s ({len(feed_entities) / best:,.0f} entities/sec)")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,64 @@
+import argparse
+import datetime
+
+import requests
+
+from field_analysis import analyze_feed, analysis_results, write_report
+from gtfs_rt_fetcher import FEED_DEFAULTS, feed_auth, load_feeds
+
+
+def feed_config(feed, auth=None, api_key_env=None, params=None):
+    # A feed from gtfs_rt_fetcher.FEEDS by name, or any URL; auth, key variable and extra
+    # query parameters override its settings
+    feeds = {config["name"]: config for config in load_feeds()}
+    config = dict(feeds[feed]) if feed in feeds else {**FEED_DEFAULTS, "name": feed, "url": feed}
+    if auth is not None:
+        config["auth"] = None if auth == 'none' else auth
+    if api_key_env:
+        config["api_key_env"] = api_key_env
+    config["params"] = {**config["params"], **(params or {})}
+    return config
+
+
+def analyse_api_feed(feed):
+    # Fetch one response and write the field analysis report for it
+    auth_params, headers = feed_auth(feed)
+    params = {**feed["params"], **auth_params}
+    response = requests.get(feed["url"], params=params, headers=headers, timeout=feed["timeout"])
+    if response.status_code != 200:
+        print("Failed to fetch data:", response.status_code)
+        return None
+
+    # One pass over every entity type, without decoding the FeedMessage as a whole
+    results = analysis_results(analyze_feed(response.content))
+
+    # Use the URL and the non-secret parameters as the title
+    title = feed["url"] + "".join(f"{'&' if i else '?'}{k}={v}" for i, (k, v) in enumerate(feed["params"].items()))
+
+    # Include a timestamp in the filename
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"api_analysis_report_{timestamp}.html"
+    write_report(results, title, filename)
+    return filename
+
+
+def parse_param(value):
+    name, _, param_value = value.partition('=')
+    if not name or not param_value:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {value!r}")
+    return name, param_value
+
+
+if __name__ == "__main__":
+    # python field_analysis_api.py bods --param startTimeAfter=1707570000
+    # python field_analysis_api.py nsw_buses
+    # python field_analysis_api.py https://example.org/gtfsrt --auth header --api-key-env MY_KEY
+    parser = argparse.ArgumentParser(description="Field analysis report for one GTFS-RT API response")
+    parser.add_argument('feed', help="a feed name from gtfs_rt_fetcher.FEEDS or a feed URL")
+    parser.add_argument('--auth', choices=('query', 'header', 'none'),
+                        help="api_key query parameter (BODS), Authorization: apikey header (NSW) or none")
+    parser.add_argument('--api-key-env', help="environment variable holding the API key")
+    parser.add_argument('--param', type=parse_param, action='append', default=[],
+                        help="extra query parameter as NAME=VALUE, may be repeated")
+    args = parser.parse_args()
+    analyse_api_feed(feed_config(args.feed, args.auth, args.api_key_env, dict(args.param)))
@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from field_analysis import analyze_file, merge_counts, used_fields, write_report
+
+# Files handed to each worker ahead of time; enough to keep it busy without queueing the
+# whole archive
+PENDING_PER_WORKER = 2
+
+
+def archive_paths(pattern):
+    # A directory (searched recursively for .bin files) or a glob such as 'archive/2024-02-*/*.bin'.
+    # A glob may also match the .jsonl per-file counts of earlier runs, which are merged as they are.
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '**', '*.bin')
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def coverage(counts):
+    # Share of its possible occurrences in which each field was present, keyed entity_type.path
+    return {f"{name}.{path}": data["present"] / (data["present"] + data["absent"])
+            for name, result in counts.items() for path, data in result["fields"].items()
+            if data["present"] + data["absent"]}
+
+
+def read_per_file(path):
+    # (file, counts) from the JSON lines written by an earlier analyze_archive
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            yield record["file"], record["counts"]
+
+
+def analyze_archive(paths, workers=None, per_file_path=None):
+    # Analyse every file in worker processes, merging each file's counts into the aggregate as
+    # it completes and appending them to per_file_path (JSON lines) so nothing else is kept per file.
+    # Counts and distributions are additive, so earlier runs' .jsonl files are merged in directly.
+    workers = workers or os.cpu_count()
+    per_file_path = per_file_path or f"archive_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    total = {}
+    per_file = []
+    failed = 0
+    remaining = iter([path for path in paths if not path.endswith('.jsonl')])
+    pending = {}
+    start = time.perf_counter()
+
+    def add_file(path, counts):
+        merge_counts(total, counts)
+        per_file.append((path, {name: result["count"] for name, result in counts.items()}, coverage(counts)))
+        per_file_out.write(json.dumps({"file": path, "counts": counts}) + '\n')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(per_file_path, 'w') as per_file_out:
+        for path in paths:
+            if path.endswith('.jsonl'):
+                for file, counts in read_per_file(path):
+                    add_file(file, counts)
+        while True:
+            while len(pending) < workers * PENDING_PER_WORKER:
+                path = next(remaining, None)
+                if path is None:
+                    break
+                pending[pool.submit(analyze_file, path)] = path
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    _, counts = future.result()
+                except Exception as error:
+                    # A truncated or corrupt snapshot shouldn't sink the whole run
+                    print(f"Failed to analyse {path}: {error}")
+                    failed += 1
+                    continue
+                add_file(path, counts)
+
+    elapsed = time.perf_counter() - start
+    print(f"Analysed {len(per_file)} files ({failed} failed) with {workers} workers in {elapsed:.1f}s; "
+          f"per-file counts written to '{per_file_path}'")
+    return total, sorted(per_file)
+
+
+def per_file_table(per_file, results):
+    # One row per file: entities of each type and the coverage of every field in the aggregate
+    types = list(results)
+    columns = [f"{name}.{path}" for name in types for path in results[name]["fields"]]
+    header = ''.join(f'<th>{column}</th>' for column in ['File'] + types + columns)
+    rows = []
+    for path, entity_counts, file_coverage in per_file:
+        cells = [path] + [entity_counts.get(name, 0) for name in types] + \
+                [f"{file_coverage[column]:.0%}" if column in file_coverage else '' for column in columns]
+        rows.append('<tr>' + ''.join(f'<td>{cell}</td>' for cell in cells) + '</tr>')
+    return f"""<h2>Per File</h2>
+    <div style="overflow-x: auto;">
+        <table border="1" style="border-collapse: collapse; font-size: small;">
+            <tr>{header}</tr>
+            {''.join(rows)}
+        </table>
+    </div>"""
+
+
+def report_archive(pattern, workers=None):
+    paths = archive_paths(pattern)
+    if not paths:
+        raise ValueError(f"No .bin or .jsonl files found for {pattern}")
+    total, per_file = analyze_archive(paths, workers)
+    results = used_fields(total)
+    title = f"{pattern} ({len(per_file)} files)"
+    filename = f"archive_analysis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+    write_report(results, title, filename, extra_html=per_file_table(per_file, results))
+
+
+def benchmark(file_path, copies=16):
+    # Files per second over the same snapshot repeated, for 1 worker up to one per core
+    paths = [file_path] * copies
+    baseline = None
+    workers = 1
+    while True:
+        start = time.perf_counter()
+        analyze_archive(paths, workers, os.devnull)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{workers} workers: {copies / elapsed:.2f} files/sec ({baseline / elapsed:.2f}x)")
+        if workers >= os.cpu_count():
+            break
+        workers = min(workers * 2, os.cpu_count())
+
+
+if __name__ == "__main__":
+    # python field_analysis_archive.py archive/ [workers]
+    # python field_analysis_archive.py 'archive_analysis_*.jsonl'
+    # python field_analysis_archive.py benchmark gtfs_files/gtfsrt.bin
+    if len(sys.argv) > 2 and sys.argv[1] == 'benchmark':
+        benchmark(sys.argv[2])
+    else:
+        report_archive(sys.argv[1] if len(sys.argv) > 1 else 'gtfs_files',
+                       int(sys.argv[2]) if len(sys.argv) > 2 else None)
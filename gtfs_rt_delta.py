@@ -0,0 +1,180 @@
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from gtfs_rt_flatten import VEHICLE_POSITION_FLATTENER, flatten_vehicle_positions_from_bytes
+from gtfs_rt_wire import read_feed_header
+from gtfs_rt_parquet import (COMPRESSION, FILE_SCHEMA, to_table, write_vehicle_positions, directory_size,
+                             read_vehicle_positions_csv)
+
+DELTA_ROOT = 'vehicle_position_deltas'
+
+# Polls between full keyframes (an hour at the 30 second poll interval)
+KEYFRAME_EVERY = 120
+
+# Files are <root>/<feed timestamp>-<write time ns>-keyframe.parquet (every vehicle) or
+# <feed timestamp>-<write time ns>-delta.parquet (vehicles that are new or changed since the
+# previous poll, op 'upsert', and vehicles that have left the feed, op 'remove'). The write time
+# keeps two polls with the same header timestamp but different content from overwriting each
+# other, and orders them.
+KEYFRAME = 'keyframe'
+DELTA = 'delta'
+
+
+def unkeyed(df):
+    # Positions without a vehicle id, which can't be followed from one poll to the next
+    return df['vehicle_id'].fillna('').astype(str) == '' if 'vehicle_id' in df.columns else pd.Series(True, df.index)
+
+
+def normalise_snapshot(df):
+    # One row per vehicle_id with every flattened column present. Feeds can list a vehicle
+    # more than once; the latest position wins. Positions without a vehicle id are left out.
+    df = df[~unkeyed(df)]
+    df = df.assign(**{name: default for name, _, default in VEHICLE_POSITION_FLATTENER[0] if name not in df.columns})
+    df = df[[name for name, _, _ in VEHICLE_POSITION_FLATTENER[0]]]
+    df = df.sort_values('timestamp', kind='stable').drop_duplicates('vehicle_id', keep='last')
+    return df.set_index(pd.Index(df['vehicle_id'].to_numpy(dtype=object)))
+
+
+def new_delta_state():
+    return {"hashes": pd.Series(dtype=np.uint64), "polls_since_keyframe": None}
+
+
+def diff_snapshot(state, df):
+    # (rows that are new or changed, vehicle_ids no longer present) against the last snapshot.
+    # A row counts as changed if any column differs, compared by a 64-bit hash of the row.
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    previous = state["hashes"]
+    positions = previous.index.get_indexer(hashes.index)
+    known = positions >= 0
+    unchanged = np.zeros(len(hashes), dtype=bool)
+    unchanged[known] = previous.to_numpy()[positions[known]] == hashes.to_numpy()[known]
+    removed = previous.index.difference(hashes.index)
+    state["hashes"] = hashes
+    return df[~unchanged], removed
+
+
+def write_snapshot(state, df, root=DELTA_ROOT, feed_timestamp=None, keyframe_every=KEYFRAME_EVERY):
+    # Record one poll: a keyframe on the first poll and every keyframe_every polls after,
+    # otherwise only the differences (nothing at all if no vehicle changed). Returns (kind,
+    # rows written, positions skipped for having no vehicle id).
+    skipped = int(unkeyed(df).sum())
+    df = normalise_snapshot(df)
+    feed_timestamp = int(feed_timestamp or time.time())
+    changes, removed = diff_snapshot(state, df)
+
+    if state["polls_since_keyframe"] is None or state["polls_since_keyframe"] + 1 >= keyframe_every:
+        state["polls_since_keyframe"] = 0
+        kind, rows, ops = KEYFRAME, df, ['upsert'] * len(df)
+    else:
+        state["polls_since_keyframe"] += 1
+        if changes.empty and removed.empty:
+            return DELTA, 0, skipped
+        kind = DELTA
+        rows = pd.concat([changes, pd.DataFrame({'vehicle_id': removed})], ignore_index=True)
+        ops = ['upsert'] * len(changes) + ['remove'] * len(removed)
+
+    table = to_table(rows.reset_index(drop=True), feed_timestamp).select(FILE_SCHEMA.names)
+    table = table.append_column('op', pa.array(ops, type=pa.dictionary(pa.int8(), pa.string())))
+    os.makedirs(root, exist_ok=True)
+    pq.write_table(table, os.path.join(root, f"{feed_timestamp}-{time.time_ns()}-{kind}.parquet"),
+                   compression=COMPRESSION)
+    return kind, len(rows), skipped
+
+
+def make_delta_handler(root=DELTA_ROOT, keyframe_every=KEYFRAME_EVERY, flatten=flatten_vehicle_positions_from_bytes):
+    # Holds the last state between polls. After a restart the state is empty, so the first
+    # poll writes a keyframe.
+    state = new_delta_state()
+
+    def save_feed_as_delta(content):
+        kind, rows, skipped = write_snapshot(state, flatten(content), root,
+                                             read_feed_header(content).timestamp, keyframe_every)
+        print(f"{rows} vehicle positions written to '{root}' as a {kind}"
+              + (f", {skipped} without a vehicle id skipped" if skipped else ""))
+
+    return save_feed_as_delta
+
+
+def snapshot_files(root=DELTA_ROOT):
+    # [(feed timestamp, kind, path)] in the order written. Files from before the write time was
+    # added to the name (<feed timestamp>-<kind>) sort first within their feed timestamp.
+    files = []
+    for path in glob.glob(os.path.join(root, '*.parquet')):
+        parts = os.path.basename(path)[:-len('.parquet')].split('-')
+        feed_timestamp, written, kind = parts if len(parts) == 3 else (parts[0], 0, parts[1])
+        files.append((int(feed_timestamp), int(written), kind, path))
+    return [(feed_timestamp, kind, path) for feed_timestamp, _, kind, path in sorted(files)]
+
+
+def reconstruct_fleet(root=DELTA_ROOT, at=None):
+    # Every vehicle's last known position as of feed timestamp at (default: the latest poll):
+    # the nearest keyframe at or before it with the deltas after it applied in order
+    files = [entry for entry in snapshot_files(root) if at is None or entry[0] <= at]
+    keyframes = [i for i, (_, kind, _) in enumerate(files) if kind == KEYFRAME]
+    if not keyframes:
+        raise ValueError(f"No keyframe in '{root}' at or before {at}")
+
+    fleet = pq.read_table(files[keyframes[-1]][2]).to_pandas()
+    fleet = fleet.set_index(fleet['vehicle_id'].to_numpy())
+    for _, _, path in files[keyframes[-1] + 1:]:
+        delta = pq.read_table(path).to_pandas()
+        delta = delta.set_index(delta['vehicle_id'].to_numpy())
+        upserts = delta[delta['op'] == 'upsert']
+        fleet = pd.concat([fleet.drop(delta.index, errors='ignore'), upserts])
+    return fleet.drop(columns='op').sort_index()
+
+
+def simulate_polls(df, polls, interval):
+    # Polls derived from one real snapshot: vehicles that were reporting in its last five
+    # minutes move and advance their timestamp each poll, the rest repeat unchanged (as stale
+    # vehicles do in BODS)
+    snapshot_time = int(df['timestamp'].max())
+    live = (df['timestamp'] >= snapshot_time - 300).to_numpy()
+    rng = np.random.default_rng(0)
+    for i in range(polls):
+        poll = df.copy()
+        poll.loc[live, 'timestamp'] += interval * i
+        poll.loc[live, 'position_latitude'] += rng.normal(0, 5e-4, live.sum())
+        poll.loc[live, 'position_longitude'] += rng.normal(0, 5e-4, live.sum())
+        yield snapshot_time + interval * i, poll
+
+
+def benchmark(csv_path='vehicle_positions_20240210_153512.csv', polls=20, interval=30):
+    # Rows and bytes written for the same polls in delta mode and as full snapshots
+    df = read_vehicle_positions_csv(csv_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        delta_root, full_root = os.path.join(tmp_dir, 'delta'), os.path.join(tmp_dir, 'full')
+        state = new_delta_state()
+        rows_seen = rows_written = 0
+        delta_seconds = full_seconds = 0.0
+        for feed_timestamp, poll in simulate_polls(df, polls, interval):
+            start = time.perf_counter()
+            rows_written += write_snapshot(state, poll, delta_root, feed_timestamp)[1]
+            delta_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            rows_seen += write_vehicle_positions(poll, full_root, feed_timestamp)
+            full_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        fleet = reconstruct_fleet(delta_root)
+        rebuild_seconds = time.perf_counter() - start
+        expected = normalise_snapshot(poll)
+        same = len(fleet) == len(expected) and \
+            (fleet['timestamp'] == pd.to_datetime(expected['timestamp'].loc[fleet.index], unit='s', utc=True)).all()
+
+        print(f"{polls} polls of {len(df)} rows: full snapshots wrote {rows_seen} rows, {directory_size(full_root):,} bytes "
+              f"in {full_seconds:.2f}s; delta mode wrote {rows_written} rows ({rows_written / rows_seen:.1%}), "
+              f"{directory_size(delta_root):,} bytes in {delta_seconds:.2f}s.")
+        print(f"Rebuilt fleet state of {len(fleet)} vehicles in {rebuild_seconds:.2f}s, matches last poll: {same}")
+
+
+if __name__ == "__main__":
+    benchmark(*sys.argv[1:2])
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import requests
+from aiohttp import web
+
+import gtfs_realtime_pb2
+from gtfs_rt_wire import ENTITY_TYPES, iter_entity_spans, read_feed_header
+
+# Feeds to fetch. auth is "query" (api_key parameter, as BODS), "header" (Authorization: apikey,
+# as Transport for NSW) or None; the key is read from the api_key_env environment variable.
+# queries lists extra parameter sets fetched each poll (e.g. one per operatorRef), at most
+# concurrency of them in flight and no more than rate_limit requests per second.
+FEEDS = [
+    {"name": "bods", "url": "https://data.bus-data.dft.gov.uk/api/v1/gtfsrtdatafeed/",
+     "auth": "query", "api_key_env": "GTFS_API_KEY", "interval": 30, "rate_limit": 1.0},
+    {"name": "nsw_buses", "url": "https://api.transport.nsw.gov.au/v1/gtfs/vehiclepos/buses",
+     "auth": "header", "api_key_env": "NSW_API_KEY", "interval": 15, "rate_limit": 5.0},
+]
+
+FEED_DEFAULTS = {
+    "auth": None,
+    "api_key_env": "GTFS_API_KEY",
+    "params": {},
+    "queries": [{}],
+    "interval": 30,
+    "concurrency": 1,
+    "rate_limit": None,
+    "timeout": 60,
+    "retries": 3,
+    "backoff": 1.0,
+    "max_backoff": 60.0,
+}
+
+# Responses worth retrying; anything else is reported and the query skipped until the next poll
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def load_feeds(path=None):
+    # Feed configs from a JSON list in the FEEDS format, with FEED_DEFAULTS filled in
+    feeds = FEEDS
+    if path:
+        with open(path, 'r') as f:
+            feeds = json.load(f)
+    return [{**FEED_DEFAULTS, **feed} for feed in feeds]
+
+
+def feed_auth(feed):
+    # (params, headers) carrying the feed's API key
+    if not feed["auth"]:
+        return {}, {}
+    api_key = os.environ.get(feed["api_key_env"])
+    if not api_key:
+        raise ValueError(f"API key not found for {feed['name']}. Set the {feed['api_key_env']} environment variable.")
+    if feed["auth"] == "query":
+        return {'api_key': api_key}, {}
+    if feed["auth"] == "header":
+        return {}, {'Authorization': f'apikey {api_key}'}
+    raise ValueError(f"Unknown auth style {feed['auth']!r} for {feed['name']}")
+
+
+def new_feed_state(feed):
+    return {
+        "semaphore": asyncio.Semaphore(feed["concurrency"]),
+        "rate_lock": asyncio.Lock(),
+        "next_request": 0.0,
+        "requests": 0,
+        "retries": 0,
+        "failed": 0,
+        "decoded": 0,
+        "decode_errors": 0,
+        "bytes": 0,
+    }
+
+
+def backoff_delay(attempt, base, cap):
+    # Full jitter: spreads retries from many feeds/queries rather than retrying in lockstep
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def wait_for_rate_limit(feed, state):
+    if not feed["rate_limit"]:
+        return
+    loop = asyncio.get_running_loop()
+    async with state["rate_lock"]:
+        now = loop.time()
+        if state["next_request"] > now:
+            await asyncio.sleep(state["next_request"] - now)
+            now = state["next_request"]
+        state["next_request"] = now + 1.0 / feed["rate_limit"]
+
+
+async def fetch_feed(session, feed, state, params, headers):
+    # Raw body of one request, retried with jittered exponential backoff; None if it failed
+    for attempt in range(feed["retries"] + 1):
+        retry_after = None
+        async with state["semaphore"]:
+            await wait_for_rate_limit(feed, state)
+            state["requests"] += 1
+            try:
+                async with session.get(feed["url"], params=params, headers=headers,
+                                       timeout=aiohttp.ClientTimeout(total=feed["timeout"])) as response:
+                    if response.status == 200:
+                        content = await response.read()
+                        state["bytes"] += len(content)
+                        return content
+                    if response.status not in RETRY_STATUSES:
+                        state["failed"] += 1
+                        print(f"{feed['name']}: failed to fetch data: {response.status}")
+                        return None
+                    error = f"HTTP {response.status}"
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = f"{type(e).__name__}: {e}"
+
+        if attempt == feed["retries"]:
+            break
+        delay = backoff_delay(attempt, feed["backoff"], feed["max_backoff"])
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        state["retries"] += 1
+        print(f"{feed['name']}: {error}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    state["failed"] += 1
+    print(f"{feed['name']}: failed to fetch data after {feed['retries'] + 1} attempts: {error}")
+    return None
+
+
+def summarise_feed(content):
+    # Default decoder, run in the worker pool - must stay a picklable top-level function.
+    # Entity types are counted from the wire tags without decoding the entities.
+    header = read_feed_header(content)
+    if header is None:
+        raise ValueError("response has no FeedHeader")
+    types = Counter(entity_type for entity_type, _, _ in iter_entity_spans(content))
+    return {
+        "timestamp": header.timestamp,
+        "entities": sum(types.values()),
+        "vehicles": types[ENTITY_TYPES['vehicle']],
+        "trip_updates": types[ENTITY_TYPES['trip_update']],
+        "alerts": types[ENTITY_TYPES['alert']],
+    }
+
+
+def print_result(feed, query, result):
+    print(f"{feed['name']} {query or ''}: {result}")
+
+
+async def fetch_and_decode(session, pool, feed, state, query, auth, decode, handle_result):
+    params, headers = auth
+    content = await fetch_feed(session, feed, state, {**feed["params"], **query, **params}, headers)
+    if content is None:
+        return
+    # Parsing is CPU bound; doing it in the pool keeps the event loop free for the other feeds
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(pool, decode, content)
+    except Exception as e:
+        # A truncated or malformed body fails this query only, not the other feeds in the gather
+        state["decode_errors"] += 1
+        print(f"{feed['name']} {query or ''}: failed to decode feed: {type(e).__name__}: {e}")
+        return
+    state["decoded"] += 1
+    handle_result(feed, query, result)
+
+
+async def poll_feed(session, pool, feed, decode, handle_result, max_polls=None):
+    state = new_feed_state(feed)
+    # A missing API key or bad auth style takes this feed out before its first poll, leaving the others running
+    try:
+        auth = feed_auth(feed)
+    except ValueError as e:
+        state["failed"] += 1
+        print(f"{feed['name']}: not polled: {e}")
+        return feed["name"], state
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        started = time.monotonic()
+        await asyncio.gather(*(fetch_and_decode(session, pool, feed, state, query, auth, decode, handle_result)
+                               for query in feed["queries"]))
+        polls += 1
+        if max_polls is not None and polls >= max_polls:
+            break
+        await asyncio.sleep(max(0.0, feed["interval"] - (time.monotonic() - started)))
+    return feed["name"], state
+
+
+async def run_fetcher(feeds, decode=summarise_feed, handle_result=print_result, workers=None, max_polls=None):
+    # Poll every feed concurrently on its own interval, decoding responses in a process pool
+    connector = aiohttp.TCPConnector(limit=sum(feed["concurrency"] for feed in feeds))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        async with aiohttp.ClientSession(connector=connector, headers={"Accept-Encoding": "gzip, deflate"}) as session:
+            results = await asyncio.gather(*(poll_feed(session, pool, feed, decode, handle_result, max_polls)
+                                             for feed in feeds))
+    states = dict(results)
+    for name, state in states.items():
+        print(f"{name}: {state['requests']} requests, {state['decoded']} decoded, "
+              f"{state['decode_errors']} decode errors, {state['retries']} retries, "
+              f"{state['failed']} failed, {state['bytes']} bytes.")
+    return states
+
+
+def make_mock_feed(entities):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    for i in range(entities):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        entity.vehicle.trip.trip_id = f"VJ{random.getrandbits(160):040x}"
+        entity.vehicle.trip.route_id = str(random.randint(1000, 99999))
+        entity.vehicle.vehicle.id = str(i)
+        entity.vehicle.position.latitude = 50 + random.random() * 5
+        entity.vehicle.position.longitude = -5 + random.random() * 6
+        entity.vehicle.timestamp = feed.header.timestamp - random.randint(0, 120)
+    return feed.SerializeToString()
+
+
+def start_mock_servers(content, delays):
+    # One local HTTP server per delay, each answering every request with content after that
+    # many seconds. They run on their own event loop thread so blocking clients can use them too.
+    loop = asyncio.new_event_loop()
+    urls = []
+
+    def make_handler(delay):
+        async def handler(request):
+            await asyncio.sleep(delay)
+            return web.Response(body=content, content_type='application/octet-stream')
+        return handler
+
+    async def start():
+        for delay in delays:
+            app = web.Application()
+            app.router.add_get('/', make_handler(delay))
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            urls.append(f"http://127.0.0.1:{runner.addresses[0][1]}/")
+
+    loop.run_until_complete(start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return urls
+
+
+def benchmark(feed_count=6, queries_per_feed=10, entities=5000, delay=0.1, slow_delay=2.0, workers=None):
+    # Fetch+decode throughput against local mock servers, one of which is slow: blocking
+    # requests one at a time against the async engine
+    content = make_mock_feed(entities)
+    urls = start_mock_servers(content, [slow_delay] + [delay] * (feed_count - 1))
+    feeds = [{**FEED_DEFAULTS, "name": f"mock_{i}", "url": url, "concurrency": 4,
+              "queries": [{"query": str(q)} for q in range(queries_per_feed)]} for i, url in enumerate(urls)]
+    total = feed_count * queries_per_feed
+    megabytes = total * len(content) / 1e6
+
+    start = time.perf_counter()
+    session = requests.Session()
+    for feed in feeds:
+        for query in feed["queries"]:
+            summarise_feed(session.get(feed["url"], params=query).content)
+    sequential = time.perf_counter() - start
+    print(f"Sequential: {total} feeds in {sequential:.2f}s ({total / sequential:.1f} feeds/s, "
+          f"{megabytes / sequential:.1f} MB/s).")
+
+    finished = {}
+
+    def record(feed, query, result):
+        finished[feed["name"]] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(run_fetcher(feeds, handle_result=record, workers=workers, max_polls=1))
+    concurrent = time.perf_counter() - start
+    print(f"Async: {total} feeds in {concurrent:.2f}s ({total / concurrent:.1f} feeds/s, "
+          f"{megabytes / concurrent:.1f} MB/s), {sequential / concurrent:.1f}x sequential.")
+    for name, seconds in sorted(finished.items(), key=lambda item: item[1]):
+        print(f"  {name} finished after {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+    else:
+        asyncio.run(run_fetcher(load_feeds(sys.argv[1] if len(sys.argv) > 1 else None)))
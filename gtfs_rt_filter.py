@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from gtfs_rt_flatten import (VEHICLE_POSITION_FLATTENER, flatten_messages, flatten_vehicle_positions_from_bytes,
+                             flatten_vehicle_spans)
+from gtfs_rt_wire import iter_entities, iter_entity_spans
+
+# Route lists longer than this are filtered client-side rather than sent as routeId
+MAX_PUSHDOWN_ROUTES = 50
+
+
+def parse_bbox(text):
+    # 'min_lat,min_lon,max_lat,max_lon' from the command line
+    values = tuple(float(value) for value in text.split(','))
+    if len(values) != 4:
+        raise ValueError(f"Expected min_lat,min_lon,max_lat,max_lon, got {text!r}")
+    return values
+
+
+def add_filter_arguments(parser):
+    # The filter options shared by GTFS_API_Request_BODS.py and gtfs_rt_poller.py
+    parser.add_argument('--bbox', type=parse_bbox, metavar='MIN_LAT,MIN_LON,MAX_LAT,MAX_LON',
+                        help="only vehicles inside this box, e.g. 53.9,-1.2,54.0,-1.0")
+    parser.add_argument('--route', dest='route_ids', action='append', metavar='ROUTE_ID',
+                        help="only vehicles on this route (repeatable)")
+    parser.add_argument('--operator', dest='operators', action='append', metavar='OPERATOR',
+                        help="only vehicles of this operator: agency id, NOC or name (repeatable, needs --static-db)")
+    parser.add_argument('--static-db', default=os.environ.get('GTFS_STATIC_DB'),
+                        help="static GTFS database the operators are looked up in (default: $GTFS_STATIC_DB)")
+
+
+def filter_from_arguments(args):
+    # (BODS query parameters, client-side filter) from the add_filter_arguments options
+    conn = None
+    if args.operators:
+        if not args.static_db:
+            raise ValueError("--operator needs --static-db or the GTFS_STATIC_DB environment variable")
+        conn = sqlite3.connect(args.static_db)
+    try:
+        return query_params(make_vehicle_filter(args.bbox, args.route_ids, args.operators, conn))
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def make_vehicle_filter(bbox=None, route_ids=None, operators=None, conn=None):
+    # bbox is (min_lat, min_lon, max_lat, max_lon). Operators (agency_id, NOC or name) are not
+    # a GTFS-RT query parameter, so they are resolved to their routes with the static database.
+    routes = set(route_ids) if route_ids else None
+    if operators:
+        operator_routes = operator_route_ids(conn, operators)
+        routes = operator_routes if routes is None else routes & operator_routes
+    return {"bbox": bbox, "route_ids": routes}
+
+
+def operator_route_ids(conn, operators):
+    placeholders = ', '.join('?' * len(operators))
+    cursor = conn.cursor()
+    cursor.execute(f'''
+    SELECT r.route_id
+    FROM routes r
+    JOIN agency a ON a.agency_id = r.agency_id
+    WHERE a.agency_id IN ({placeholders}) OR a.agency_noc IN ({placeholders}) OR a.agency_name IN ({placeholders});
+    ''', list(operators) * 3)
+    route_ids = {row[0] for row in cursor.fetchall()}
+    if not route_ids:
+        print(f"No routes found for operators {', '.join(operators)}")
+    return route_ids
+
+
+def query_params(vehicle_filter):
+    # (BODS GTFS-RT query parameters, the part of the filter still to apply client-side)
+    params = {}
+    remaining = dict(vehicle_filter)
+    if vehicle_filter["bbox"]:
+        min_lat, min_lon, max_lat, max_lon = vehicle_filter["bbox"]
+        # BODS takes the box as minLongitude,minLatitude,maxLongitude,maxLatitude
+        params['boundingBox'] = f"{min_lon},{min_lat},{max_lon},{max_lat}"
+        remaining["bbox"] = None
+    if vehicle_filter["route_ids"] is not None and 0 < len(vehicle_filter["route_ids"]) <= MAX_PUSHDOWN_ROUTES:
+        params['routeId'] = ','.join(sorted(vehicle_filter["route_ids"]))
+        remaining["route_ids"] = None
+    return params, remaining
+
+
+def is_empty(vehicle_filter):
+    return vehicle_filter["bbox"] is None and vehicle_filter["route_ids"] is None
+
+
+def matching_vehicles(data, vehicle_filter):
+    # Decoded VehiclePositions passing the filter. trip_update and alert entities are skipped on
+    # the wire, but every vehicle entity is decoded: protobuf's C parser decodes a vehicle faster
+    # than its position and route can be read from the wire in Python (2.5x faster over 25,000
+    # vehicles). The filter saves the flattening. Only the fields filtered on are then read,
+    # and the tests run over whole columns at once.
+    vehicles = [entity.vehicle for entity in iter_entities(data, ('vehicle',))]
+    if is_empty(vehicle_filter) or not vehicles:
+        return vehicles
+
+    bbox, route_ids = vehicle_filter["bbox"], vehicle_filter["route_ids"]
+    keep = np.ones(len(vehicles), dtype=bool)
+    if bbox:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        latitudes = np.fromiter((vehicle.position.latitude for vehicle in vehicles), dtype=np.float32, count=len(vehicles))
+        longitudes = np.fromiter((vehicle.position.longitude for vehicle in vehicles), dtype=np.float32, count=len(vehicles))
+        keep &= (latitudes >= min_lat) & (latitudes <= max_lat) & (longitudes >= min_lon) & (longitudes <= max_lon)
+    if route_ids is not None:
+        routes = pd.Series([vehicle.trip.route_id for vehicle in vehicles], dtype=object)
+        keep &= routes.isin(route_ids).to_numpy()
+    return [vehicles[i] for i in np.flatnonzero(keep)]
+
+
+def flatten_filtered_vehicle_positions(data, vehicle_filter):
+    # As gtfs_rt_flatten.flatten_vehicle_positions_from_bytes, flattening only the vehicles
+    # that pass the filter
+    if is_empty(vehicle_filter):
+        return flatten_vehicle_positions_from_bytes(data)
+    vehicles = matching_vehicles(data, vehicle_filter)
+    return flatten_messages(vehicles, VEHICLE_POSITION_FLATTENER, len(vehicles))
+
+
+def benchmark(file_path, vehicle_filters=None):
+    # Time to flatten a feed file whole against pre-filtering at a few selectivities
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if vehicle_filters is None:
+        vehicle_filters = {
+            "England and Wales": make_vehicle_filter(bbox=(49.9, -6.4, 55.9, 1.8)),
+            "Yorkshire": make_vehicle_filter(bbox=(53.3, -2.6, 54.6, -0.1)),
+            "York": make_vehicle_filter(bbox=(53.9, -1.2, 54.0, -1.0)),
+        }
+
+    start = time.perf_counter()
+    everything = flatten_vehicle_spans(data, [(s, e) for _, s, e in iter_entity_spans(data, ('vehicle',))])
+    full_seconds = time.perf_counter() - start
+    print(f"No filter: {len(everything)} vehicles in {full_seconds:.3f}s")
+    for name, vehicle_filter in vehicle_filters.items():
+        start = time.perf_counter()
+        df = flatten_filtered_vehicle_positions(data, vehicle_filter)
+        seconds = time.perf_counter() - start
+        print(f"{name}: {len(df)} vehicles ({len(df) / max(len(everything), 1):.1%}) in {seconds:.3f}s "
+              f"({seconds / full_seconds:.0%} of the unfiltered time)")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'gtfs_files/gtfsrt.bin')
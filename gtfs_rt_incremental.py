@@ -0,0 +1,116 @@
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+from gtfs_rt_flatten import flatten_vehicle_positions_from_bytes
+from gtfs_rt_parquet import PARQUET_ROOT, write_vehicle_positions
+from gtfs_rt_wire import read_feed_header
+
+# Newest observation timestamp stored so far, per feed
+WATERMARK_PATH = 'watermarks.json'
+
+# Each request reaches this far back before the high-water mark, to pick up observations
+# that reached the API late; anything already stored is dropped by the seen-set
+OVERLAP_SECONDS = 120
+
+# Window asked for when a feed has no high-water mark yet
+INITIAL_LOOKBACK_SECONDS = 3600
+
+# (vehicle_id, timestamp) keys are remembered for SEEN_RETENTION seconds behind the newest
+# observation, and never more than SEEN_MAX_KEYS of them
+SEEN_RETENTION = 600
+SEEN_MAX_KEYS = 500000
+
+
+def load_watermarks(path=WATERMARK_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_watermark(feed_name, watermark, path=WATERMARK_PATH):
+    watermarks = load_watermarks(path)
+    watermarks[feed_name] = watermark
+    # Write then rename, so a crash never leaves a half-written file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(watermarks, f, indent=4)
+    os.replace(temp_path, path)
+
+
+def new_seen_set(floor=0, retention=SEEN_RETENTION, max_keys=SEEN_MAX_KEYS):
+    # Observations older than floor count as already seen: their keys have been evicted (or,
+    # after a restart, were stored before the overlap window)
+    return {"keys": set(), "order": deque(), "floor": floor, "newest": floor,
+            "retention": retention, "max_keys": max_keys}
+
+
+def drop_seen(seen, df, feed_timestamp=None):
+    # Rows of df whose (vehicle_id, timestamp) has not been seen before, remembering them. The
+    # newest observation is capped at feed_timestamp, as the watermark is, so one vehicle with
+    # a clock running fast can't raise the floor past everything that follows. Positions with
+    # no timestamp are keyed on feed_timestamp instead, or kept as they are without one.
+    keys, order, floor = seen["keys"], seen["order"], seen["floor"]
+    keep = np.zeros(len(df), dtype=bool)
+    timestamps = df['timestamp'].to_numpy(dtype=np.int64)
+    if feed_timestamp:
+        timestamps = np.where(timestamps > 0, timestamps, feed_timestamp)
+    else:
+        keep[timestamps <= 0] = True
+    for i, key in enumerate(zip(df['vehicle_id'].to_numpy(dtype=object), timestamps.tolist())):
+        if key[1] <= 0 or key[1] < floor or key in keys:
+            continue
+        keys.add(key)
+        order.append(key)
+        keep[i] = True
+
+    if len(timestamps):
+        newest = int(timestamps.max())
+        seen["newest"] = max(seen["newest"], min(newest, feed_timestamp) if feed_timestamp else newest)
+    seen["floor"] = max(floor, seen["newest"] - seen["retention"])
+    # Keys arrive roughly in time order, so evicting from the front drops the oldest; past
+    # max_keys the oldest go early, at the risk of letting a very late duplicate through
+    while order and (order[0][1] < seen["floor"] or len(keys) > seen["max_keys"]):
+        keys.discard(order.popleft())
+    return df[keep]
+
+
+def store_as_parquet(df, feed_timestamp):
+    write_vehicle_positions(df, PARQUET_ROOT, feed_timestamp)
+
+
+def make_incremental_poll(feed_name, store=store_as_parquet, path=WATERMARK_PATH, overlap=OVERLAP_SECONDS,
+                          initial_lookback=INITIAL_LOOKBACK_SECONDS, flatten=flatten_vehicle_positions_from_bytes):
+    # (params, handle_feed) for run_poller: params asks for startTimeAfter just before the
+    # feed's high-water mark, handle_feed stores only unseen observations with
+    # store(df, feed_timestamp) and then advances the mark
+    watermark = load_watermarks(path).get(feed_name)
+    # After a restart the first request reaches back overlap seconds as usual; the keys stored
+    # before the restart are gone, so that window may be stored twice rather than losing late data
+    seen = new_seen_set(floor=watermark - overlap if watermark else 0)
+    state = {"watermark": watermark}
+
+    def params():
+        if state["watermark"]:
+            return {'startTimeAfter': state["watermark"] - overlap}
+        return {'startTimeAfter': int(time.time()) - initial_lookback}
+
+    def handle_feed(content):
+        df = flatten(content)
+        feed_timestamp = read_feed_header(content).timestamp
+        new = drop_seen(seen, df, feed_timestamp)
+        print(f"{feed_name}: {len(new)} new of {len(df)} vehicle positions")
+        if new.empty:
+            return
+        store(new, feed_timestamp)
+        # Never past the feed's own clock, in case a vehicle reports a time in the future
+        newest = int(new['timestamp'].max())
+        state["watermark"] = max(state["watermark"] or 0, min(newest, feed_timestamp) if feed_timestamp else newest)
+        save_watermark(feed_name, state["watermark"], path)
+
+    return params, handle_feed
+
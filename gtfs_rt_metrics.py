@@ -0,0 +1,154 @@
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from distribution_sketch import sketch_quantiles
+from field_analysis import analysis_counts, analyze_feed, merge_counts
+
+# Sliding windows the field counters are kept over, by label
+WINDOWS = {'5m': 300, '1h': 3600}
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+
+def new_metrics(feed_name, windows=WINDOWS):
+    # Each window keeps the per-poll counts it covers and their running total: a poll is added
+    # to the total once when it arrives and taken out once when it leaves the window
+    return {"feed": feed_name, "lock": threading.Lock(), "last_poll": None,
+            "windows": {name: {"seconds": seconds, "polls": deque(), "total": {}} for name, seconds in windows.items()}}
+
+
+def expire_polls(window, now):
+    polls = window["polls"]
+    while polls and polls[0][0] <= now - window["seconds"]:
+        merge_counts(window["total"], polls.popleft()[1], sign=-1)
+
+
+def record_counts(metrics, counts, now=None):
+    now = now or time.time()
+    with metrics["lock"]:
+        metrics["last_poll"] = now
+        for window in metrics["windows"].values():
+            window["polls"].append((now, counts))
+            merge_counts(window["total"], counts)
+            expire_polls(window, now)
+
+
+def record_feed(metrics, content, now=None):
+    # Analyse one poll's feed bytes (every entity type, in one pass) into the windows
+    counts = analysis_counts(analyze_feed(content))
+    record_counts(metrics, counts, now)
+    return counts
+
+
+def make_metrics_handler(metrics, handle_feed=None):
+    # Records each feed into metrics before passing it on to handle_feed
+    def record_and_handle(content):
+        record_feed(metrics, content)
+        if handle_feed is not None:
+            handle_feed(content)
+
+    return record_and_handle
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{' + ','.join(f'{name}="{label_value(value)}"' for name, value in values.items()) + '}'
+
+
+def render_metrics(metrics_list, now=None):
+    # Prometheus text exposition format, one series per feed/window/entity type/field
+    now = now or time.time()
+    series = {
+        "gtfs_rt_polls": ("gauge", "Feed polls recorded in the window", []),
+        "gtfs_rt_entities": ("gauge", "Entities of each type seen in the window", []),
+        "gtfs_rt_field_present": ("gauge", "Occurrences of a field in the window", []),
+        "gtfs_rt_field_absent": ("gauge", "Times a field could have occurred in the window but did not", []),
+        "gtfs_rt_field_coverage": ("gauge", "Share of possible occurrences in which a field was present", []),
+        "gtfs_rt_field_value": ("gauge", "Occurrences of each enum (or small integer) value of a field", []),
+        "gtfs_rt_field_quantile": ("gauge", "Quantiles of a numeric field (and feed_lag) over the window", []),
+        "gtfs_rt_last_poll_timestamp_seconds": ("gauge", "Unix time the feed was last recorded", []),
+    }
+    for metrics in metrics_list:
+        feed = metrics["feed"]
+        with metrics["lock"]:
+            if metrics["last_poll"] is not None:
+                series["gtfs_rt_last_poll_timestamp_seconds"][2].append((labels(feed=feed), metrics["last_poll"]))
+            for window_name, window in metrics["windows"].items():
+                # Windows drain even when the feed stops arriving
+                expire_polls(window, now)
+                series["gtfs_rt_polls"][2].append((labels(feed=feed, window=window_name), len(window["polls"])))
+                for entity_type, result in window["total"].items():
+                    base = dict(feed=feed, window=window_name, entity_type=entity_type)
+                    series["gtfs_rt_entities"][2].append((labels(**base), result["count"]))
+                    for path, data in result["fields"].items():
+                        present, absent = data["present"], data["absent"]
+                        if not present + absent:
+                            continue
+                        field_labels = labels(**base, field=path)
+                        series["gtfs_rt_field_present"][2].append((field_labels, present))
+                        series["gtfs_rt_field_absent"][2].append((field_labels, absent))
+                        series["gtfs_rt_field_coverage"][2].append((field_labels, round(present / (present + absent), 6)))
+                        for value, count in data["unique_values"].items():
+                            series["gtfs_rt_field_value"][2].append((labels(**base, field=path, value=value), count))
+                        if "distribution" in data:
+                            for quantile, value in sketch_quantiles(data["distribution"]["sketch"]).items():
+                                series["gtfs_rt_field_quantile"][2].append(
+                                    (labels(**base, field=path, quantile=quantile), round(value, 6)))
+
+    lines = []
+    for name, (metric_type, help_text, samples) in series.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(f"{name}{sample_labels} {value}" for sample_labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics_list, host=METRICS_HOST, port=METRICS_PORT):
+    # Serve /metrics from a background thread; returns the server (server.shutdown() to stop)
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_metrics(metrics_list).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # one line per scrape would drown out the poller's output
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def replay_files(paths, interval=5, port=METRICS_PORT):
+    # Feed saved .bin snapshots through the metrics as if they were polls, e.g. to try out
+    # dashboards and alerts, then keep serving
+    metrics = new_metrics('replay')
+    serve_metrics([metrics], port=port)
+    for path in paths:
+        with open(path, 'rb') as f:
+            start = time.perf_counter()
+            counts = record_feed(metrics, f.read())
+        entities = sum(result["count"] for result in counts.values())
+        print(f"{path}: {entities} entities recorded in {time.perf_counter() - start:.2f}s")
+        time.sleep(interval)
+    while True:
+        time.sleep(60)
+
+
+if __name__ == "__main__":
+    # python gtfs_rt_metrics.py gtfs_files/gtfsrt.bin [more .bin files ...]
+    replay_files(sys.argv[1:] or ['gtfs_files/gtfsrt.bin'])
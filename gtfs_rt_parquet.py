@@ -0,0 +1,252 @@
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from google.protobuf.descriptor import FieldDescriptor
+
+import gtfs_realtime_pb2
+from gtfs_rt_flatten import VEHICLE_POSITION_FLATTENER, flatten_vehicle_positions_from_bytes
+from gtfs_rt_wire import read_feed_header
+
+PARQUET_ROOT = 'vehicle_positions'
+FEED_NAME = 'bods'
+
+# Service dates are local to the feed's operating area
+TIMEZONE = 'Europe/London'
+
+COMPRESSION = 'zstd'
+# Compacted files are written once and read many times, so they get a slower, tighter level
+COMPACT_COMPRESSION_LEVEL = 9
+
+# Files are laid out as <root>/feed=<name>/service_date=YYYYMMDD/*.parquet: one file per poll
+# until compact_partitions merges them
+PARTITION_SCHEMA = pa.schema([('feed', pa.string()), ('service_date', pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+
+# Per-poll files merged into one compacted file at a time (an hour at the 30 second poll
+# interval), which also bounds the memory compaction needs
+COMPACT_FILES = 120
+
+ARROW_TYPES = {
+    FieldDescriptor.CPPTYPE_INT32: pa.int32(),
+    FieldDescriptor.CPPTYPE_UINT32: pa.uint32(),
+    FieldDescriptor.CPPTYPE_INT64: pa.int64(),
+    FieldDescriptor.CPPTYPE_UINT64: pa.uint64(),
+    FieldDescriptor.CPPTYPE_ENUM: pa.int8(),
+    FieldDescriptor.CPPTYPE_FLOAT: pa.float32(),
+    FieldDescriptor.CPPTYPE_DOUBLE: pa.float64(),
+    FieldDescriptor.CPPTYPE_BOOL: pa.bool_(),
+}
+
+# Rows are ordered so each vehicle's positions sit together: its ids repeat in runs and its
+# coordinates change by small steps, which is what dictionary/RLE encoding and zstd feed on
+SORT_KEYS = [('vehicle_id', 'ascending'), ('timestamp', 'ascending')]
+
+
+def vehicle_positions_schema():
+    # The flattened VehiclePosition columns (same names and order as gtfs_rt_flatten) with
+    # their protobuf widths: floats stay 32-bit, enums 8-bit, and text ids are dictionary
+    # encoded. timestamp/feed_timestamp are UTC timestamps, null where the feed left them unset.
+    fields = []
+
+    def add_fields(descriptor, prefix):
+        for field in descriptor.fields:
+            name = f"{prefix}{field.name}"
+            if field.label == field.LABEL_REPEATED:
+                fields.append(pa.field(name, pa.string()))
+            elif field.type == field.TYPE_MESSAGE:
+                add_fields(field.message_type, name + '_')
+            elif name == 'timestamp':
+                fields.append(pa.field(name, pa.timestamp('s', tz='UTC')))
+            elif field.cpp_type == field.CPPTYPE_STRING:
+                fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+            else:
+                fields.append(pa.field(name, ARROW_TYPES[field.cpp_type]))
+
+    add_fields(gtfs_realtime_pb2.VehiclePosition.DESCRIPTOR, '')
+    fields.append(pa.field('feed_timestamp', pa.timestamp('s', tz='UTC')))
+    return pa.schema(fields + list(PARTITION_SCHEMA))
+
+
+SCHEMA = vehicle_positions_schema()
+# As stored: dictionary columns are plain strings in the files and decoded back to dictionaries on read
+WRITE_SCHEMA = pa.schema([field.with_type(pa.string()) if pa.types.is_dictionary(field.type) else field
+                          for field in SCHEMA])
+FILE_SCHEMA = pa.schema([field for field in WRITE_SCHEMA if field.name not in PARTITION_SCHEMA.names])
+
+
+def epoch_array(seconds):
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return pa.array(seconds, type=pa.timestamp('s', tz='UTC'), mask=seconds == 0)
+
+
+def to_table(df, feed_timestamp=None, feed=FEED_NAME):
+    # Arrow table in SCHEMA from a flattened DataFrame (or a CSV read back into one); columns
+    # missing from older CSVs take the proto defaults
+    feed_timestamp = int(feed_timestamp or time.time())
+    arrays = []
+    for name, _, default in VEHICLE_POSITION_FLATTENER[0]:
+        field_type = SCHEMA.field(name).type
+        values = df[name].fillna(default) if name in df.columns else pd.Series([default] * len(df))
+        if name == 'timestamp':
+            arrays.append(epoch_array(values))
+        elif pa.types.is_dictionary(field_type):
+            # Written as plain strings - Parquet dictionary encodes each file's column chunks,
+            # whereas an Arrow dictionary here would be copied whole into every partition
+            arrays.append(pa.array(values.astype(str), type=pa.string()))
+        elif pa.types.is_string(field_type):
+            arrays.append(pa.array(values.astype(str), type=pa.string()))
+        else:
+            arrays.append(pa.array(values.to_numpy().astype(field_type.to_pandas_dtype()), type=field_type))
+    arrays.append(epoch_array(np.full(len(df), feed_timestamp)))
+
+    # Partition by the trip's service date where the feed gives one, else by the local date of
+    # the position
+    seconds = pd.Series(df['timestamp'].fillna(0).astype(np.int64) if 'timestamp' in df.columns else 0,
+                        index=df.index)
+    seconds = seconds.where(seconds > 0, feed_timestamp)
+    local = pd.to_datetime(seconds, unit='s', utc=True).dt.tz_convert(TIMEZONE)
+    start_dates = df['trip_start_date'].fillna('').astype(str) if 'trip_start_date' in df.columns else ''
+    service_dates = np.where(start_dates != '', start_dates, local.dt.strftime('%Y%m%d'))
+    arrays.append(pa.array(np.full(len(df), feed, dtype=object), type=pa.string()))
+    arrays.append(pa.array(service_dates, type=pa.string()))
+    return pa.Table.from_arrays(arrays, schema=WRITE_SCHEMA)
+
+
+# Floats are split into byte streams rather than dictionary encoded: coordinates are nearly all
+# distinct, but their sign and exponent bytes repeat and compress well on their own
+FLOAT_COLUMNS = [field.name for field in FILE_SCHEMA if pa.types.is_floating(field.type)]
+ENCODING_OPTIONS = {
+    "use_dictionary": [field.name for field in FILE_SCHEMA if field.name not in FLOAT_COLUMNS],
+    "use_byte_stream_split": FLOAT_COLUMNS,
+}
+
+
+def sorting_columns(schema):
+    # Recorded in the file metadata so readers know the rows are in SORT_KEYS order
+    return list(pq.SortingColumn.from_ordering(schema, SORT_KEYS))
+
+
+def write_options():
+    return ds.ParquetFileFormat().make_write_options(compression=COMPRESSION, **ENCODING_OPTIONS,
+                                                     sorting_columns=sorting_columns(FILE_SCHEMA))
+
+
+def write_vehicle_positions(df, root=PARQUET_ROOT, feed_timestamp=None, feed=FEED_NAME):
+    # Append one poll's positions: a new file in each service_date partition it touches
+    table = to_table(df, feed_timestamp, feed).sort_by(SORT_KEYS)
+    ds.write_dataset(table, root, format='parquet', partitioning=PARTITIONING,
+                     basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+                     existing_data_behavior='overwrite_or_ignore', file_options=write_options(),
+                     preserve_order=True)
+    return table.num_rows
+
+
+def save_feed_as_parquet(content, root=PARQUET_ROOT, flatten=flatten_vehicle_positions_from_bytes):
+    # Appends each poll to the dataset, partitioned by the feed header's timestamp
+    rows = write_vehicle_positions(flatten(content), root,
+                                   read_feed_header(content).timestamp)
+    print(f"{rows} vehicle positions appended to '{root}'")
+
+
+def read_vehicle_positions(root=PARQUET_ROOT, columns=None, filter=None):
+    # e.g. columns=['vehicle_id', 'position_latitude'],
+    #      filter=(ds.field('feed') == 'bods') & (ds.field('service_date') == '20240210')
+    # Only the requested columns of the matching partitions are read, and row groups whose
+    # statistics rule them out (e.g. a vehicle_id filter on compacted files) are skipped.
+    dataset = ds.dataset(root, schema=SCHEMA, format='parquet', partitioning=PARTITIONING)
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def poll_files(partition_dir):
+    return sorted(glob.glob(os.path.join(partition_dir, 'part-*.parquet')))
+
+
+def compact_partition(partition_dir, paths=None):
+    # Merge per-poll files of a feed/service_date partition into one file sorted by vehicle and
+    # time, so a vehicle's repeated ids and small moves from poll to poll compress together.
+    # Files compacted earlier are left alone, so a day ends up as a handful of compacted files.
+    paths = paths or poll_files(partition_dir)
+    if len(paths) < 2:
+        return
+    table = pa.concat_tables([pq.read_table(path, schema=FILE_SCHEMA) for path in paths])
+    table = table.sort_by(SORT_KEYS)
+    temp_path = os.path.join(partition_dir, f".compacted-{time.time_ns()}.tmp")
+    pq.write_table(table, temp_path, compression=COMPRESSION, compression_level=COMPACT_COMPRESSION_LEVEL,
+                   sorting_columns=sorting_columns(table.schema), **ENCODING_OPTIONS)
+    os.replace(temp_path, os.path.join(partition_dir, f"compacted-{time.time_ns()}.parquet"))
+    for path in paths:
+        os.remove(path)
+
+
+def newest_observation(paths):
+    # Latest position time in a partition's files (the feed timestamp where a position has none)
+    newest = None
+    for path in paths:
+        table = pq.read_table(path, columns=['timestamp', 'feed_timestamp'])
+        latest = pc.max(pc.coalesce(table['timestamp'], table['feed_timestamp'])).as_py()
+        if latest is not None and (newest is None or latest > newest):
+            newest = latest
+    return newest
+
+
+def compact_partitions(root=PARQUET_ROOT, before_hours=2, compact_files=COMPACT_FILES):
+    # Merge the per-poll files of each partition compact_files at a time as they accumulate, and
+    # the rest once the partition's newest observation is before_hours old (the poller may still
+    # be writing to it until then). The service date can't be used for this: trips running
+    # past midnight keep writing to the previous service date's partition.
+    cutoff = pd.Timestamp.now(tz=TIMEZONE) - pd.Timedelta(hours=before_hours)
+    for partition_dir in glob.glob(os.path.join(root, 'feed=*', 'service_date=*')):
+        paths = poll_files(partition_dir)
+        while len(paths) >= compact_files:
+            compact_partition(partition_dir, paths[:compact_files])
+            paths = paths[compact_files:]
+        if len(paths) < 2:
+            continue
+        newest = newest_observation(paths)
+        if newest is not None and pd.Timestamp(newest) <= cutoff:
+            compact_partition(partition_dir, paths)
+
+
+def read_vehicle_positions_csv(csv_path):
+    # A vehicle_positions_<timestamp>.csv snapshot with text ids kept as text; older snapshots
+    # use dotted column names (position.latitude)
+    text_columns = [name for name, dtype, _ in VEHICLE_POSITION_FLATTENER[0] if dtype is object]
+    df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    df.columns = [name.replace('.', '_') for name in df.columns]
+    for name in df.columns:
+        if name not in text_columns:
+            df[name] = pd.to_numeric(df[name].replace('', np.nan))
+    return df
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dir_path, name))
+               for dir_path, _, names in os.walk(path) for name in names)
+
+
+def convert_csvs(csv_paths, root=PARQUET_ROOT):
+    # Load CSV snapshots into the dataset and compare the storage used
+    csv_bytes = 0
+    for csv_path in csv_paths:
+        df = read_vehicle_positions_csv(csv_path)
+        feed_timestamp = int(df['timestamp'].max()) if 'timestamp' in df.columns else None
+        rows = write_vehicle_positions(df, root, feed_timestamp)
+        csv_bytes += os.path.getsize(csv_path)
+        print(f"{csv_path}: {rows} rows")
+    compact_partitions(root)
+    parquet_bytes = directory_size(root)
+    print(f"{len(csv_paths)} CSVs: {csv_bytes:,} bytes; Parquet: {parquet_bytes:,} bytes "
+          f"({csv_bytes / parquet_bytes:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    csv_paths = sys.argv[1:] or sorted(glob.glob('vehicle_positions_*.csv'))
+    convert_csvs(csv_paths)
@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from gtfs_rt_wire import read_feed_header
+from gtfs_rt_flatten import flatten_vehicle_positions_from_bytes
+from GTFS_API_Request_BODS import url as BODS_URL, save_vehicle_positions
+
+# Seconds between the start of one poll and the next
+POLL_INTERVAL = 30
+REQUEST_TIMEOUT = 60
+
+
+def create_session(pool_size=4, retries=3, backoff_factor=1):
+    # One pooled keep-alive session for the life of the poller; gateway errors are retried with
+    # exponential backoff before the poll counts as failed
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, backoff_factor=backoff_factor,
+                                            status_forcelist=(502, 503, 504)))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return session
+
+
+def new_poll_state():
+    return {
+        "etag": None,
+        "last_modified": None,
+        "content_hash": None,
+        "feed_timestamp": None,
+        "polls": 0,
+        "not_modified": 0,
+        "unchanged": 0,
+        "stale": 0,
+        "invalid": 0,
+        "processed": 0,
+        "failed": 0,
+        "bytes": 0,
+    }
+
+
+def fetch_if_changed(session, url, params, state, headers=None):
+    # Returns the raw feed if it has changed since the last poll, otherwise None. Unchanged
+    # feeds are caught by conditional headers (304), then by content hash, then by a header
+    # timestamp no newer than the last one - all before the entities are parsed.
+    state["polls"] += 1
+    request_headers = dict(headers or {})
+    if state["etag"]:
+        request_headers["If-None-Match"] = state["etag"]
+    if state["last_modified"]:
+        request_headers["If-Modified-Since"] = state["last_modified"]
+
+    response = session.get(url, params=params, headers=request_headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        state["not_modified"] += 1
+        return None
+    if response.status_code != 200:
+        state["failed"] += 1
+        print("Failed to fetch data:", response.status_code)
+        return None
+
+    content = response.content
+    state["bytes"] += len(content)
+    state["etag"] = response.headers.get("ETag")
+    state["last_modified"] = response.headers.get("Last-Modified")
+
+    content_hash = hashlib.blake2b(content, digest_size=16).digest()
+    if content_hash == state["content_hash"]:
+        state["unchanged"] += 1
+        return None
+
+    header = read_feed_header(content)
+    if header is None:
+        # Not a FeedMessage (an error page, a truncated body); the handlers all need the header
+        state["invalid"] += 1
+        print("Response has no FeedHeader, skipping")
+        return None
+    feed_timestamp = header.timestamp if header.HasField('timestamp') else None
+    if feed_timestamp is not None and state["feed_timestamp"] is not None and feed_timestamp < state["feed_timestamp"]:
+        # An older copy of the feed, e.g. from a lagging cache node
+        state["stale"] += 1
+        return None
+
+    state["content_hash"] = content_hash
+    state["feed_timestamp"] = feed_timestamp
+    state["processed"] += 1
+    return content
+
+
+# Handlers for run_poller take the raw bytes of each changed feed, which always has a header.
+# The storage handlers (this one, gtfs_rt_parquet, gtfs_rt_delta, gtfs_rt_incremental and
+# gtfs_rt_trajectory) take a flatten(content) -> DataFrame of positions, by default every
+# vehicle; pass a gtfs_rt_filter pre-filter to keep only some.
+def save_feed_as_csv(content, flatten=flatten_vehicle_positions_from_bytes):
+    save_vehicle_positions(flatten(content))
+
+
+def run_poller(url, params=None, handle_feed=save_feed_as_csv, interval=POLL_INTERVAL, session=None,
+               headers=None, max_polls=None, sleep=time.sleep):
+    # Poll url every interval seconds, passing each changed feed's bytes to handle_feed. params
+    # may be a function, called before each poll (e.g. for a moving startTimeAfter)
+    session = session or create_session()
+    state = new_poll_state()
+    while max_polls is None or state["polls"] < max_polls:
+        started = time.monotonic()
+        try:
+            content = fetch_if_changed(session, url, params() if callable(params) else params, state, headers)
+            if content is not None:
+                handle_feed(content)
+        except requests.RequestException as e:
+            state["failed"] += 1
+            print("Failed to fetch data:", e)
+
+        print(f"Poll {state['polls']}: {state['processed']} processed, {state['not_modified']} not modified, "
+              f"{state['unchanged']} unchanged, {state['stale']} stale, {state['invalid']} invalid, {state['failed']} failed, "
+              f"{state['bytes']} feed bytes received")
+        if max_polls is not None and state["polls"] >= max_polls:
+            break
+        sleep(max(0.0, interval - (time.monotonic() - started)))
+    return state
+
+
+if __name__ == "__main__":
+    # python gtfs_rt_poller.py [interval] [mode] [metrics port] [--bbox ...] [--route ...] [--operator ...]
+    # 'parquet' appends to the partitioned dataset instead of writing a CSV per poll, 'delta'
+    # writes only the vehicles that changed since the last poll, 'incremental' requests only
+    # data newer than the stored high-water mark and appends only unseen observations,
+    # 'trajectory' appends to the per-vehicle trajectory store. A metrics port serves rolling
+    # field coverage metrics.
+    from gtfs_rt_filter import add_filter_arguments, filter_from_arguments, flatten_filtered_vehicle_positions
+
+    parser = argparse.ArgumentParser(description="Poll the BODS GTFS-RT feed")
+    parser.add_argument('interval', nargs='?', type=float, default=POLL_INTERVAL)
+    parser.add_argument('mode', nargs='?', default='csv', choices=('csv', 'incremental', 'parquet', 'delta', 'trajectory'))
+    parser.add_argument('metrics_port', nargs='?', type=int)
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+
+    api_key = os.environ.get('GTFS_API_KEY')
+    if not api_key:
+        raise ValueError("API key not found. Set the GTFS_API_KEY environment variable.")
+
+    # The bounding box and short route lists are sent to BODS; the rest is filtered before flattening
+    filter_params, vehicle_filter = filter_from_arguments(args)
+    flatten = lambda content: flatten_filtered_vehicle_positions(content, vehicle_filter)
+    params = {**filter_params, 'api_key': api_key}
+    if args.mode == 'incremental':
+        from gtfs_rt_incremental import make_incremental_poll
+        incremental_params, handle_feed = make_incremental_poll('bods', flatten=flatten)
+        params = lambda: {**incremental_params(), **filter_params, 'api_key': api_key}
+    elif args.mode == 'parquet':
+        from gtfs_rt_parquet import save_feed_as_parquet
+        handle_feed = lambda content: save_feed_as_parquet(content, flatten=flatten)
+    elif args.mode == 'delta':
+        from gtfs_rt_delta import make_delta_handler
+        handle_feed = make_delta_handler(flatten=flatten)
+    elif args.mode == 'trajectory':
+        from gtfs_rt_trajectory import make_trajectory_handler
+        handle_feed = make_trajectory_handler(flatten=flatten)
+    else:
+        handle_feed = lambda content: save_feed_as_csv(content, flatten)
+    if args.metrics_port:
+        from gtfs_rt_metrics import new_metrics, make_metrics_handler, serve_metrics
+        metrics = new_metrics('bods')
+        serve_metrics([metrics], port=args.metrics_port)
+        handle_feed = make_metrics_handler(metrics, handle_feed)
+    run_poller(BODS_URL, params=params, handle_feed=handle_feed, interval=args.interval)
@@ -0,0 +1,178 @@
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from gtfs_rt_parquet import TIMEZONE, read_vehicle_positions_csv
+from timetable_cache import NO_TIME, compile_timetable, decode_ids, find_indexes, load_timetable
+
+
+def trip_sequence_keys(timetable):
+    # Timetable rows are ordered by (trip, stop_sequence), so trip << 32 | stop_sequence is a
+    # sorted key and (trip, stop_sequence) -> row is one searchsorted for a whole snapshot
+    if "trip_sequence_keys" not in timetable:
+        timetable["trip_sequence_keys"] = (timetable["st_trip"].astype(np.int64) << 32) | timetable["st_sequence"]
+    return timetable["trip_sequence_keys"]
+
+
+def trip_stop_keys(timetable):
+    # (sorted trip << 32 | stop keys, timetable rows in that order), for vehicles that give a
+    # stop_id but no stop_sequence. Stable, so a stop a trip visits twice matches its first visit.
+    if "trip_stop_keys" not in timetable:
+        keys = (timetable["st_trip"].astype(np.int64) << 32) | timetable["st_stop"]
+        order = np.argsort(keys, kind='stable')
+        timetable["trip_stop_keys"] = keys[order], order
+    return timetable["trip_stop_keys"]
+
+
+def lookup_rows(keys, wanted, order=None):
+    # Timetable row of each wanted key in sorted keys, -1 where absent
+    rows = np.full(len(wanted), -1, dtype=np.int64)
+    if not len(keys):
+        return rows
+    positions = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    found = keys[positions] == wanted
+    rows[found] = positions[found] if order is None else order[positions[found]]
+    return rows
+
+
+def service_day_start(date):
+    # Epoch seconds that GTFS times on a YYYYMMDD service date count from: noon minus 12 hours,
+    # which is midnight except on the days the clocks change
+    noon = pd.Timestamp(datetime.strptime(date, '%Y%m%d') + timedelta(hours=12), tz=TIMEZONE)
+    return int(noon.timestamp()) - 43200
+
+
+def service_day_starts(dates):
+    # service_day_start over a column of dates, computed once per distinct date; NaN for
+    # blank or malformed dates
+    starts = {}
+    for date in pd.unique(dates):
+        try:
+            starts[date] = service_day_start(date)
+        except (TypeError, ValueError):
+            starts[date] = np.nan
+    return pd.Series(dates).map(starts).to_numpy(dtype=np.float64)
+
+
+def join_schedule(timetable, df):
+    # Each vehicle's scheduled time at its current stop and how far behind it is, for a whole
+    # snapshot at once. Vehicles are matched to the timetable on (trip_id, current_stop_sequence),
+    # or (trip_id, stop_id) when the feed leaves the sequence unset. Adds scheduled_time (epoch
+    # seconds) and schedule_deviation (seconds, positive = late); both NaN where unmatched.
+    count = len(df)
+    trip_ids = df['trip_trip_id'].fillna('').astype(str) if 'trip_trip_id' in df.columns else pd.Series([''] * count)
+    trips = find_indexes(timetable["trip_ids"], trip_ids.to_numpy())
+    known = trips >= 0
+
+    sequences = df['current_stop_sequence'].fillna(0).to_numpy(dtype=np.int64) \
+        if 'current_stop_sequence' in df.columns else np.zeros(count, dtype=np.int64)
+    rows = np.full(count, -1, dtype=np.int64)
+    rows[known] = lookup_rows(trip_sequence_keys(timetable), (trips[known] << 32) | sequences[known])
+
+    # A sequence of 0 is usually the field left unset (though GTFS allows it), so the stop_id
+    # takes precedence there
+    if 'stop_id' in df.columns:
+        stop_ids = df['stop_id'].fillna('').astype(str).to_numpy()
+        by_stop = known & ((rows < 0) | (sequences == 0)) & (stop_ids != '')
+        if by_stop.any():
+            stops = find_indexes(timetable["stop_ids"], stop_ids[by_stop])
+            keys, order = trip_stop_keys(timetable)
+            stop_rows = lookup_rows(keys, (trips[by_stop] << 32) | stops, order)
+            rows[by_stop] = np.where((stops >= 0) & (stop_rows >= 0), stop_rows, rows[by_stop])
+
+    # Arrival at the stop, or its departure where only that is given
+    matched = rows >= 0
+    scheduled = np.full(count, np.nan)
+    arrivals = timetable["st_arrival"][rows[matched]]
+    departures = timetable["st_departure"][rows[matched]]
+    seconds = np.where(arrivals != NO_TIME, arrivals, departures).astype(np.float64)
+    seconds[seconds == NO_TIME] = np.nan
+    scheduled[matched] = seconds
+
+    # Times count from the trip's service date; without one it is the vehicle's local date or,
+    # for a trip running past midnight, the day before - whichever is nearer the vehicle's time
+    timestamps = df['timestamp'].fillna(0).to_numpy(dtype=np.float64)
+    local_dates = pd.to_datetime(timestamps, unit='s', utc=True).tz_convert(TIMEZONE).tz_localize(None).normalize()
+    dates, date_codes = np.unique(local_dates.to_numpy(), return_inverse=True)
+    dates = pd.DatetimeIndex(dates)
+    today = service_day_starts(dates.strftime('%Y%m%d'))[date_codes]
+    yesterday = service_day_starts((dates - pd.Timedelta(days=1)).strftime('%Y%m%d'))[date_codes]
+    deviation_today = timestamps - (today + scheduled)
+    deviation_yesterday = timestamps - (yesterday + scheduled)
+    day_starts = np.where(np.abs(deviation_yesterday) < np.abs(deviation_today), yesterday, today)
+    if 'trip_start_date' in df.columns:
+        start_dates = service_day_starts(df['trip_start_date'].fillna('').astype(str).to_numpy())
+        day_starts = np.where(np.isnan(start_dates), day_starts, start_dates)
+
+    scheduled_times = day_starts + scheduled
+    scheduled_times[timestamps <= 0] = np.nan
+    return df.assign(scheduled_time=scheduled_times, schedule_deviation=timestamps - scheduled_times)
+
+
+def summarise_deviation(df):
+    deviation = df['schedule_deviation'].dropna()
+    print(f"Matched {len(deviation)} of {len(df)} vehicles to the timetable")
+    if len(deviation):
+        print(f"Deviation: median {deviation.median():.0f}s, p90 {deviation.quantile(0.9):.0f}s; "
+              f"{(deviation.abs() <= 300).mean():.1%} within 5 minutes, {(deviation > 300).mean():.1%} late, "
+              f"{(deviation < -60).mean():.1%} early")
+
+
+def simulate_snapshot(timetable, vehicles=25000):
+    # Vehicles placed at random stop times of random trips, a few minutes either side of schedule;
+    # a fifth give only a stop_id and a few run trips the timetable doesn't have
+    rows = np.array(random.choices(range(len(timetable["st_trip"])), k=vehicles))
+    trip_ids = decode_ids(timetable["trip_ids"], timetable["st_trip"][rows])
+    stop_ids = decode_ids(timetable["stop_ids"], timetable["st_stop"][rows])
+    seconds = np.where(timetable["st_arrival"][rows] != NO_TIME, timetable["st_arrival"][rows],
+                       timetable["st_departure"][rows])
+    service_date = datetime.now().strftime('%Y%m%d')
+    delays = np.random.default_rng(0).normal(60, 180, vehicles).astype(np.int64)
+    sequences = timetable["st_sequence"][rows].astype(np.int64)
+    sequences[::5] = 0
+    for i in range(0, vehicles, 100):
+        trip_ids[i] = 'unknown-trip'
+    return pd.DataFrame({
+        'trip_trip_id': trip_ids,
+        'trip_start_date': [service_date] * vehicles,
+        'current_stop_sequence': sequences,
+        'stop_id': stop_ids,
+        'timestamp': service_day_start(service_date) + seconds + delays,
+    })
+
+
+def benchmark(timetable, vehicles=25000, rounds=5):
+    df = simulate_snapshot(timetable, vehicles)
+    join_schedule(timetable, df.head(10))  # builds the cached keys
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        joined = join_schedule(timetable, df)
+        timings.append(time.perf_counter() - start)
+    print(f"Joined {vehicles} vehicles to the timetable in {np.median(timings) * 1000:.0f}ms (median of {rounds})")
+    summarise_deviation(joined)
+
+
+if __name__ == "__main__":
+    # python gtfs_rt_schedule.py gtfs_data.db [vehicle_positions_<timestamp>.csv]
+    db_name = sys.argv[1]
+    timetable_path = f"{db_name}.timetable"
+    if not os.path.exists(timetable_path):
+        conn = sqlite3.connect(db_name)
+        compile_timetable(conn, timetable_path)
+        conn.close()
+    timetable = load_timetable(timetable_path)
+    if len(sys.argv) > 2:
+        joined = join_schedule(timetable, read_vehicle_positions_csv(sys.argv[2]))
+        summarise_deviation(joined)
+        csv_filename = f"schedule_deviation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        joined.to_csv(csv_filename, index=False)
+        print(f"Schedule deviation saved to '{csv_filename}'")
+    else:
+        benchmark(timetable)
@@ -0,0 +1,216 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from gtfs_rt_flatten import VEHICLE_POSITION_FLATTENER, flatten_vehicle_positions_from_bytes
+
+TRAJECTORY_DB = 'trajectories.db'
+
+# Positions are kept at full resolution for THIN_AFTER_HOURS, then thinned to one per vehicle
+# per THIN_SECONDS, and dropped altogether after RETENTION_DAYS
+THIN_AFTER_HOURS = 24
+THIN_SECONDS = 60
+RETENTION_DAYS = 30
+
+# Flattened vehicle position column (see gtfs_rt_flatten) -> trajectory column
+POSITION_COLUMNS = {
+    'vehicle_id': 'vehicle_id',
+    'timestamp': 'timestamp',
+    'position_latitude': 'latitude',
+    'position_longitude': 'longitude',
+    'position_bearing': 'bearing',
+    'position_speed': 'speed',
+    'trip_trip_id': 'trip_id',
+    'trip_route_id': 'route_id',
+}
+
+
+def create_trajectory_db(db_name=TRAJECTORY_DB):
+    # positions is clustered on (vehicle_id, timestamp): a vehicle's path is one contiguous
+    # range of the table, and a repeated observation (stale vehicles are re-sent every poll)
+    # is ignored by the primary key. The timestamp index serves time window queries.
+    conn = sqlite3.connect(db_name)
+    cursor = conn.cursor()
+    # Must be set before the first table is created for freed pages to be reclaimable
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS positions (
+        vehicle_id TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        latitude REAL,
+        longitude REAL,
+        bearing REAL,
+        speed REAL,
+        trip_id TEXT,
+        route_id TEXT,
+        PRIMARY KEY (vehicle_id, timestamp)) WITHOUT ROWID;
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_positions_timestamp ON positions (timestamp);')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trajectory_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER);
+    ''')
+    conn.commit()
+    return conn
+
+
+def position_rows(df):
+    # (vehicle_id, timestamp, ...) tuples in clustered key order, skipping positions without a
+    # vehicle id or timestamp (nothing to key them on)
+    missing = [name for name in POSITION_COLUMNS if name not in df.columns]
+    df = df.assign(**{name: None for name in missing})[list(POSITION_COLUMNS)]
+    df = df[(df['vehicle_id'].fillna('') != '') & (df['timestamp'].fillna(0) > 0)]
+    df = df.sort_values(['vehicle_id', 'timestamp']).astype({'timestamp': np.int64})
+    # Column-wise tolist() is far cheaper than per-row conversion; NaN binds as NULL
+    return list(zip(*(df[name].tolist() for name in POSITION_COLUMNS)))
+
+
+def append_positions(conn, df):
+    # One transaction per batch; returns the number of positions that were new
+    rows = position_rows(df)
+    with conn:
+        before = conn.total_changes
+        conn.executemany('INSERT OR IGNORE INTO positions VALUES (?, ?, ?, ?, ?, ?, ?, ?);', rows)
+        return conn.total_changes - before
+
+
+def make_trajectory_handler(db_name=TRAJECTORY_DB, flatten=flatten_vehicle_positions_from_bytes):
+    # Also compacts the store once an hour
+    conn = create_trajectory_db(db_name)
+    state = {"compacted": 0}
+
+    def save_feed_as_trajectories(content):
+        df = flatten(content)
+        new = append_positions(conn, df)
+        print(f"{new} new of {len(df)} vehicle positions appended to '{db_name}'")
+        if time.time() - state["compacted"] >= 3600:
+            compact_trajectories(conn)
+            state["compacted"] = time.time()
+
+    return save_feed_as_trajectories
+
+
+def vehicle_trajectory(conn, vehicle_id, start=None, end=None):
+    # Positions of one vehicle in time order, optionally between start and end (unix seconds)
+    return pd.read_sql_query('''
+    SELECT * FROM positions
+    WHERE vehicle_id = ? AND timestamp BETWEEN ? AND ?
+    ORDER BY timestamp;
+    ''', conn, params=(vehicle_id, start or 0, end or 2 ** 62))
+
+
+def positions_between(conn, start, end):
+    # Every vehicle's positions between start and end (unix seconds)
+    return pd.read_sql_query('''
+    SELECT * FROM positions
+    WHERE timestamp BETWEEN ? AND ?
+    ORDER BY vehicle_id, timestamp;
+    ''', conn, params=(start, end))
+
+
+def compact_trajectories(conn, now=None, thin_after_hours=THIN_AFTER_HOURS, thin_seconds=THIN_SECONDS,
+                         retention_days=RETENTION_DAYS):
+    # Drop positions past retention, thin those older than thin_after_hours to the first
+    # position per vehicle per thin_seconds, and hand the freed pages back to the filesystem.
+    # Only the range not thinned on a previous run is visited.
+    now = int(now or time.time())
+    retention_cutoff = now - retention_days * 86400
+    thin_cutoff = now - thin_after_hours * 3600
+    cursor = conn.cursor()
+    row = cursor.execute("SELECT value FROM trajectory_meta WHERE key = 'thinned_before';").fetchone()
+    thinned_before = max(row[0] if row else 0, retention_cutoff)
+
+    with conn:
+        deleted = cursor.execute('DELETE FROM positions WHERE timestamp < ?;', (retention_cutoff,)).rowcount
+        thinned = 0
+        if thin_cutoff > thinned_before:
+            # A position goes if the same vehicle has an earlier one in its thin_seconds bucket,
+            # found by a short range seek on the clustered key
+            thinned = cursor.execute('''
+            DELETE FROM positions
+            WHERE timestamp >= ? AND timestamp < ?
+              AND EXISTS (
+                SELECT 1 FROM positions earlier
+                WHERE earlier.vehicle_id = positions.vehicle_id
+                  AND earlier.timestamp >= positions.timestamp - positions.timestamp % ?
+                  AND earlier.timestamp < positions.timestamp);
+            ''', (thinned_before, thin_cutoff, thin_seconds)).rowcount
+            cursor.execute("INSERT OR REPLACE INTO trajectory_meta VALUES ('thinned_before', ?);", (thin_cutoff,))
+    cursor.execute("PRAGMA incremental_vacuum;")
+    print(f"Compacted trajectories: {deleted} positions past retention removed, {thinned} thinned")
+    return deleted, thinned
+
+
+def simulate_day(vehicles=1000, positions_per_day=1000000, start=None):
+    # A day of polls of a fleet moving around, polled often enough to make up positions_per_day,
+    # as flatten_vehicle_positions DataFrames (every flattened column, unset ones at their defaults)
+    defaults = {name: default for name, _, default in VEHICLE_POSITION_FLATTENER[0]}
+    start = int(start or time.time()) - 86400
+    interval = 86400 * vehicles // positions_per_day
+    rng = np.random.default_rng(0)
+    vehicle_ids = np.array([f"{i:04d}" for i in range(vehicles)], dtype=object)
+    routes = rng.integers(1, 200, vehicles).astype(str).astype(object)
+    latitudes = rng.uniform(50.5, 55.0, vehicles)
+    longitudes = rng.uniform(-4.0, 1.0, vehicles)
+    for poll in range(positions_per_day // vehicles):
+        latitudes += rng.normal(0, 5e-4, vehicles)
+        longitudes += rng.normal(0, 5e-4, vehicles)
+        columns = {
+            'vehicle_id': vehicle_ids,
+            'timestamp': start + poll * interval + rng.integers(0, interval, vehicles),
+            'position_latitude': latitudes.astype(np.float32),
+            'position_longitude': longitudes.astype(np.float32),
+            'position_bearing': rng.uniform(0, 360, vehicles).astype(np.float32),
+            'position_speed': rng.uniform(0, 15, vehicles).astype(np.float32),
+            'trip_trip_id': routes + '-trip',
+            'trip_route_id': routes,
+        }
+        yield pd.DataFrame({name: columns.get(name, [default] * vehicles) for name, default in defaults.items()})
+
+
+def benchmark(positions_per_day=1000000, vehicles=1000):
+    # Ingest a day of polls, then time the two query shapes and a compaction
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_name = os.path.join(tmp_dir, 'trajectories.db')
+        conn = create_trajectory_db(db_name)
+        polls = list(simulate_day(vehicles, positions_per_day=positions_per_day))
+        start = time.perf_counter()
+        for df in polls:
+            append_positions(conn, df)
+        ingest_seconds = time.perf_counter() - start
+        total = conn.execute('SELECT COUNT(*) FROM positions;').fetchone()[0]
+        newest = conn.execute('SELECT MAX(timestamp) FROM positions;').fetchone()[0]
+        print(f"Ingested {total:,} positions in {len(polls)} polls in {ingest_seconds:.1f}s "
+              f"({total / ingest_seconds:,.0f}/s, {ingest_seconds / len(polls) * 1000:.1f} ms per poll); "
+              f"{os.path.getsize(db_name) / 1e6:.0f} MB")
+
+        for name, query in (
+                ("Vehicle 0279, last two hours", lambda: vehicle_trajectory(conn, '0279', newest - 7200, newest)),
+                ("Vehicle 0279, whole day", lambda: vehicle_trajectory(conn, '0279')),
+                ("All vehicles, 5 minute window", lambda: positions_between(conn, newest - 3600, newest - 3300))):
+            timings = []
+            for _ in range(5):
+                start = time.perf_counter()
+                rows = len(query())
+                timings.append(time.perf_counter() - start)
+            print(f"{name}: {rows} positions in {np.median(timings) * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        compact_trajectories(conn, now=newest + 12 * 3600)
+        print(f"Compaction of the first half day took {time.perf_counter() - start:.1f}s; "
+              f"{conn.execute('SELECT COUNT(*) FROM positions;').fetchone()[0]:,} positions remain")
+        conn.close()
+
+
+if __name__ == "__main__":
+    benchmark(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,161 @@
+import mmap
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import gtfs_realtime_pb2
+
+# Protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_FIXED32 = 5
+
+# FeedMessage field numbers
+FEED_HEADER = 1
+FEED_ENTITY = 2
+
+# FeedEntity payload field numbers by name (trip_update, vehicle, alert, ...), taken from the
+# descriptor so newer entity types are picked up with the bindings
+ENTITY_TYPES = {field.name: field.number for field in gtfs_realtime_pb2.FeedEntity.DESCRIPTOR.fields
+                if field.type == field.TYPE_MESSAGE}
+ENTITY_TYPE_NAMES = {number: name for name, number in ENTITY_TYPES.items()}
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def skip_field(data, pos, wire_type):
+    # Position just past the value of a field whose tag has already been read
+    if wire_type == WIRE_VARINT:
+        return read_varint(data, pos)[1]
+    if wire_type == WIRE_FIXED64:
+        return pos + 8
+    if wire_type == WIRE_LENGTH_DELIMITED:
+        length, pos = read_varint(data, pos)
+        return pos + length
+    if wire_type == WIRE_FIXED32:
+        return pos + 4
+    raise ValueError(f"Unsupported protobuf wire type {wire_type} at byte {pos}")
+
+
+def read_feed_header(data):
+    # Decode only the FeedHeader of a serialised FeedMessage, skipping over the entities
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number == FEED_HEADER and wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            header = gtfs_realtime_pb2.FeedHeader()
+            header.ParseFromString(bytes(data[pos:pos + length]))
+            return header
+        pos = skip_field(data, pos, wire_type)
+    return None
+
+
+def entity_type(data, pos, end):
+    # Payload field number of the FeedEntity in data[pos:end] (0 if it has none), read from
+    # the field tags alone
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number in ENTITY_TYPE_NAMES and wire_type == WIRE_LENGTH_DELIMITED:
+            return field_number
+        pos = skip_field(data, pos, wire_type)
+    return 0
+
+
+def iter_entity_spans(data, types=None):
+    # (entity type, start, end) for each FeedEntity in a serialised FeedMessage, optionally only
+    # those whose payload is one of types (e.g. ('vehicle',)). data can be bytes, a memoryview
+    # or an mmap; nothing is decoded and skipped entities are never copied.
+    wanted = None if types is None else {ENTITY_TYPES[name] for name in types}
+    pos = 0
+    size = len(data)
+    while pos < size:
+        key, pos = read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        if field_number == FEED_ENTITY and wire_type == WIRE_LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            end = pos + length
+            payload = entity_type(data, pos, end)
+            if wanted is None or payload in wanted:
+                yield payload, pos, end
+            pos = end
+        else:
+            pos = skip_field(data, pos, wire_type)
+
+
+def parse_entity(data, start, end):
+    entity = gtfs_realtime_pb2.FeedEntity()
+    entity.ParseFromString(bytes(data[start:end]))
+    return entity
+
+
+def iter_entities(data, types=None):
+    # Decoded FeedEntity messages one at a time - only one is held in memory at once
+    for _, start, end in iter_entity_spans(data, types):
+        yield parse_entity(data, start, end)
+
+
+@contextmanager
+def open_feed(path):
+    # A .bin feed file mapped read-only, for the functions above
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield data
+
+
+def iter_feed_file(path, types=None):
+    with open_feed(path) as data:
+        yield from iter_entities(data, types)
+
+
+def peak_memory(function, *args):
+    # (result, seconds, peak RSS growth in MB) of running function in a fresh worker process
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(measured_call, function, *args).result()
+
+
+def measured_call(function, *args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    return result, elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+
+def count_vehicles_parsed(path):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    with open(path, 'rb') as f:
+        feed.ParseFromString(f.read())
+    return sum(1 for entity in feed.entity if entity.HasField('vehicle'))
+
+
+def count_vehicles_streamed(path):
+    return sum(1 for _ in iter_feed_file(path, ('vehicle',)))
+
+
+def benchmark(path):
+    # Whole-feed ParseFromString then HasField('vehicle'), against streaming only the vehicle
+    # entities from the mapped file
+    print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB")
+    for name, function in (("ParseFromString", count_vehicles_parsed), ("streamed", count_vehicles_streamed)):
+        vehicles, elapsed, peak = peak_memory(function, path)
+        print(f"  {name}: {vehicles} vehicles in {elapsed:.2f}s, peak memory +{peak:.0f} MB")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'gtfs_files/gtfsrt.bin')
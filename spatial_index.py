@@ -0,0 +1,217 @@
+import math
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+# Initial search radius for nearest-stop queries, doubled until enough stops are found
+NEAREST_START_RADIUS = 250.0
+NEAREST_MAX_RADIUS = 50000.0
+
+
+def build_spatial_index(conn, tables=("stops", "shapes")):
+    # R*Tree indexes over stop positions and over the bounding box of each shape segment
+    # (consecutive pair of shape points). Rebuilt from scratch for the given tables.
+    cursor = conn.cursor()
+
+    if "stops" in tables:
+        start = time.perf_counter()
+        cursor.execute("DROP TABLE IF EXISTS stops_rtree;")
+        # The exact coordinates and stop_id ride along as auxiliary columns, so probes never touch stops
+        cursor.execute("CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon, +stop_id, +lat, +lon);")
+        cursor.execute('''
+        INSERT INTO stops_rtree (id, min_lat, max_lat, min_lon, max_lon, stop_id, lat, lon)
+        SELECT rowid, CAST(stop_lat AS REAL), CAST(stop_lat AS REAL), CAST(stop_lon AS REAL), CAST(stop_lon AS REAL),
+               stop_id, CAST(stop_lat AS REAL), CAST(stop_lon AS REAL)
+        FROM stops
+        WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL;
+        ''')
+        print(f"Indexed {cursor.rowcount} stops in stops_rtree in {time.perf_counter() - start:.2f}s.")
+
+    if "shapes" in tables:
+        start = time.perf_counter()
+        cursor.execute("DROP TABLE IF EXISTS shape_segments_rtree;")
+        cursor.execute('''
+        CREATE VIRTUAL TABLE shape_segments_rtree USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon,
+            +shape_id, +shape_pt_sequence, +from_lat, +from_lon, +to_lat, +to_lon);
+        ''')
+        cursor.execute('''
+        INSERT INTO shape_segments_rtree (min_lat, max_lat, min_lon, max_lon,
+                                          shape_id, shape_pt_sequence, from_lat, from_lon, to_lat, to_lon)
+        SELECT min(from_lat, to_lat), max(from_lat, to_lat), min(from_lon, to_lon), max(from_lon, to_lon),
+               shape_id, shape_pt_sequence, from_lat, from_lon, to_lat, to_lon
+        FROM (
+            SELECT shape_id, shape_pt_sequence,
+                   CAST(shape_pt_lat AS REAL) AS from_lat,
+                   CAST(shape_pt_lon AS REAL) AS from_lon,
+                   CAST(LEAD(shape_pt_lat) OVER w AS REAL) AS to_lat,
+                   CAST(LEAD(shape_pt_lon) OVER w AS REAL) AS to_lon
+            FROM shapes
+            WINDOW w AS (PARTITION BY shape_id ORDER BY shape_pt_sequence)
+        )
+        WHERE to_lat IS NOT NULL;
+        ''')
+        print(f"Indexed {cursor.rowcount} shape segments in shape_segments_rtree in {time.perf_counter() - start:.2f}s.")
+
+    conn.commit()
+
+
+def distance_metres(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation - accurate to well under a metre at stop-snapping distances
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000.0 * math.hypot(x, y)
+
+
+def radius_to_degrees(lat, radius):
+    dlat = radius / METRES_PER_DEGREE
+    dlon = radius / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return dlat, dlon
+
+
+def stops_in_bbox(conn, min_lat, min_lon, max_lat, max_lon):
+    cursor = conn.cursor()
+    cursor.execute('''
+    SELECT s.stop_id, s.stop_name, CAST(s.stop_lat AS REAL), CAST(s.stop_lon AS REAL)
+    FROM stops_rtree r
+    JOIN stops s ON s.rowid = r.id
+    WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?;
+    ''', (min_lat, max_lat, min_lon, max_lon))
+    # The R*Tree holds 32-bit coordinates, so trim to the box on the exact values
+    return [stop for stop in cursor.fetchall()
+            if min_lat <= stop[2] <= max_lat and min_lon <= stop[3] <= max_lon]
+
+
+def stops_within_radius(conn, lat, lon, radius):
+    # (stop_id, stop_name, distance in metres), nearest first
+    dlat, dlon = radius_to_degrees(lat, radius)
+    results = []
+    for stop_id, stop_name, stop_lat, stop_lon in stops_in_bbox(conn, lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+        distance = distance_metres(lat, lon, stop_lat, stop_lon)
+        if distance <= radius:
+            results.append((stop_id, stop_name, distance))
+    return sorted(results, key=lambda result: result[2])
+
+
+def nearest_stops(conn, lat, lon, k=1):
+    return nearest_stops_batch(conn, [(lat, lon)], k=k)[0]
+
+
+def nearest_stops_batch(conn, points, k=1, max_radius=NEAREST_MAX_RADIUS):
+    # k nearest stops to each (lat, lon), as lists of (stop_id, distance in metres). All points
+    # are probed with one R*Tree join; points without k stops inside the radius are retried
+    # with the radius doubled, up to max_radius.
+    cursor = conn.cursor()
+    results = [[] for _ in points]
+    todo = [i for i, (lat, lon) in enumerate(points) if lat is not None and lon is not None
+            and not (math.isnan(lat) or math.isnan(lon))]
+    radius = NEAREST_START_RADIUS
+
+    while todo and radius <= max_radius:
+        cursor.execute("DROP TABLE IF EXISTS temp.probe_points;")
+        cursor.execute('''
+        CREATE TEMP TABLE probe_points (
+            point_id INTEGER PRIMARY KEY, lat REAL, lon REAL,
+            min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL);
+        ''')
+        rows = []
+        for i in todo:
+            lat, lon = points[i]
+            dlat, dlon = radius_to_degrees(lat, radius)
+            rows.append((i, lat, lon, lat - dlat, lat + dlat, lon - dlon, lon + dlon))
+        cursor.executemany("INSERT INTO probe_points VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+
+        cursor.execute('''
+        SELECT p.point_id, p.lat, p.lon, r.stop_id, r.lat, r.lon
+        FROM probe_points p
+        JOIN stops_rtree r
+            ON r.max_lat >= p.min_lat AND r.min_lat <= p.max_lat
+            AND r.max_lon >= p.min_lon AND r.min_lon <= p.max_lon;
+        ''')
+        candidates = {}
+        for point_id, lat, lon, stop_id, stop_lat, stop_lon in cursor:
+            distance = distance_metres(lat, lon, stop_lat, stop_lon)
+            if distance <= radius:
+                candidates.setdefault(point_id, []).append((stop_id, distance))
+
+        retry = []
+        for i in todo:
+            found = sorted(candidates.get(i, []), key=lambda candidate: candidate[1])
+            # Only final once k stops lie inside the circle - anything beyond it may be beaten
+            # by a stop outside the box
+            if len(found) >= k or radius * 2 > max_radius:
+                results[i] = found[:k]
+            else:
+                retry.append(i)
+        todo = retry
+        radius *= 2
+
+    cursor.execute("DROP TABLE IF EXISTS temp.probe_points;")
+    return results
+
+
+def shape_segments_in_bbox(conn, min_lat, min_lon, max_lat, max_lon, shape_id=None):
+    # Segments overlapping the box: (shape_id, shape_pt_sequence, from_lat, from_lon, to_lat, to_lon)
+    cursor = conn.cursor()
+    sql = '''
+    SELECT shape_id, shape_pt_sequence, from_lat, from_lon, to_lat, to_lon
+    FROM shape_segments_rtree
+    WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?
+    '''
+    params = [min_lat, max_lat, min_lon, max_lon]
+    if shape_id is not None:
+        sql += " AND shape_id = ?"
+        params.append(shape_id)
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+def shape_segments_within_radius(conn, lat, lon, radius, shape_id=None):
+    # Segments passing within radius metres, as (shape_id, shape_pt_sequence, distance), nearest first
+    dlat, dlon = radius_to_degrees(lat, radius)
+    results = []
+    for segment in shape_segments_in_bbox(conn, lat - dlat, lon - dlon, lat + dlat, lon + dlon, shape_id):
+        distance = distance_to_segment(lat, lon, *segment[2:])
+        if distance <= radius:
+            results.append((segment[0], segment[1], distance))
+    return sorted(results, key=lambda result: result[2])
+
+
+def distance_to_segment(lat, lon, from_lat, from_lon, to_lat, to_lon):
+    # Project onto a local flat plane around the point and measure to the closest point of the segment
+    scale = math.cos(math.radians(lat))
+    ax, ay = (from_lon - lon) * scale, from_lat - lat
+    bx, by = (to_lon - lon) * scale, to_lat - lat
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, -(ax * dx + ay * dy) / length))
+    return math.hypot(ax + t * dx, ay + t * dy) * METRES_PER_DEGREE
+
+
+def snap_vehicle_positions(conn, csv_path, k=1):
+    # Nearest stop for every vehicle in a vehicle_positions_<timestamp>.csv snapshot
+    df = pd.read_csv(csv_path, dtype={'vehicle_id': str, 'vehicle.id': str})
+    # Older snapshots use dotted column names (position.latitude), newer ones underscores
+    separator = '_' if 'position_latitude' in df.columns else '.'
+    start = time.perf_counter()
+    nearest = nearest_stops_batch(conn, list(zip(df[f'position{separator}latitude'],
+                                                 df[f'position{separator}longitude'])), k=k)
+    elapsed = time.perf_counter() - start
+
+    df['nearest_stop_id'] = [found[0][0] if found else None for found in nearest]
+    df['nearest_stop_distance'] = [found[0][1] if found else None for found in nearest]
+    print(f"Snapped {len(df)} vehicle positions to stops in {elapsed:.3f}s.")
+    return df
+
+
+if __name__ == "__main__":
+    db_name = sys.argv[1]
+    csv_path = sys.argv[2] if len(sys.argv) > 2 else 'vehicle_positions_20240210_153512.csv'
+    conn = sqlite3.connect(db_name)
+    snapped = snap_vehicle_positions(conn, csv_path)
+    print(snapped.iloc[:, -2:].describe())
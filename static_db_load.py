@@ -1,12 +1,21 @@
+import argparse
 import sqlite3
-import pandas as pd
 import json
 from datetime import datetime, timedelta
 import zipfile
-import os
+import csv
+import io
+import re
+import time
+from contextlib import contextmanager
 
+from benchmark_timing import best_of
+from spatial_index import build_spatial_index
 
-def create_db_and_tables(db_name):
+
+def create_db_and_tables(db_name, compact=False):
+    # compact=True stores coordinates as REAL, stop_times times as integer seconds since service
+    # midnight and replaces trip_id/stop_id in stop_times with integer surrogate keys
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
 
@@ -23,14 +32,17 @@ def create_db_and_tables(db_name):
         agency_noc TEXT);
     ''')
 
-    cursor.execute('''
+    stop_key = "stop_key INTEGER PRIMARY KEY,\n        stop_id TEXT UNIQUE," if compact else "stop_id TEXT PRIMARY KEY,"
+    coordinate_type = "REAL" if compact else "TEXT"
+
+    cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS stops (
-        stop_id TEXT PRIMARY KEY,
+        {stop_key}
         stop_code TEXT,
         stop_name TEXT,
         stop_desc TEXT,
-        stop_lat TEXT,
-        stop_lon TEXT,
+        stop_lat {coordinate_type},
+        stop_lon {coordinate_type},
         zone_id TEXT,
         stop_url TEXT,
         location_type INTEGER,
@@ -54,11 +66,13 @@ def create_db_and_tables(db_name):
         FOREIGN KEY (agency_id) REFERENCES agency (agency_id));
     ''')
 
-    cursor.execute('''
+    trip_key = "trip_key INTEGER PRIMARY KEY,\n        trip_id TEXT UNIQUE," if compact else "trip_id TEXT PRIMARY KEY,"
+
+    cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS trips (
         route_id TEXT,
         service_id TEXT,
-        trip_id TEXT PRIMARY KEY,
+        {trip_key}
         trip_headsign TEXT,
         trip_short_name TEXT,
         direction_id INTEGER,
@@ -70,21 +84,59 @@ def create_db_and_tables(db_name):
         FOREIGN KEY (route_id) REFERENCES routes (route_id));
     ''')
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS stop_times (
-        trip_id TEXT,
-        arrival_time TEXT,
-        departure_time TEXT,
-        stop_id TEXT,
-        stop_sequence INTEGER,
-        stop_headsign TEXT,
-        pickup_type INTEGER,
-        drop_off_type INTEGER,
-        shape_dist_traveled REAL,
-        timepoint INTEGER,  -- Added column for timepoint
-        FOREIGN KEY (trip_id) REFERENCES trips (trip_id),
-        FOREIGN KEY (stop_id) REFERENCES stops (stop_id));
-    ''')
+    if compact:
+        # Clustered on (trip_key, stop_sequence); times are seconds since service midnight and may exceed 86400
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stop_times (
+            trip_key INTEGER NOT NULL,
+            arrival_time INTEGER,
+            departure_time INTEGER,
+            stop_key INTEGER,
+            stop_sequence INTEGER NOT NULL,
+            stop_headsign TEXT,
+            pickup_type INTEGER,
+            drop_off_type INTEGER,
+            shape_dist_traveled REAL,
+            timepoint INTEGER,
+            PRIMARY KEY (trip_key, stop_sequence),
+            FOREIGN KEY (trip_key) REFERENCES trips (trip_key),
+            FOREIGN KEY (stop_key) REFERENCES stops (stop_key)) WITHOUT ROWID;
+        ''')
+
+        # stop_times as published, for ad hoc queries against a compact database
+        cursor.execute('''
+        CREATE VIEW IF NOT EXISTS stop_times_text AS
+        SELECT
+            t.trip_id,
+            printf('%02d:%02d:%02d', st.arrival_time / 3600, st.arrival_time % 3600 / 60, st.arrival_time % 60) AS arrival_time,
+            printf('%02d:%02d:%02d', st.departure_time / 3600, st.departure_time % 3600 / 60, st.departure_time % 60) AS departure_time,
+            s.stop_id,
+            st.stop_sequence,
+            st.stop_headsign,
+            st.pickup_type,
+            st.drop_off_type,
+            st.shape_dist_traveled,
+            st.timepoint
+        FROM stop_times st
+        JOIN trips t ON t.trip_key = st.trip_key
+        LEFT JOIN stops s ON s.stop_key = st.stop_key;
+        ''')
+    else:
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stop_times (
+            trip_id TEXT,
+            arrival_time TEXT,
+            departure_time TEXT,
+            stop_id TEXT,
+            stop_sequence INTEGER,
+            stop_headsign TEXT,
+            pickup_type INTEGER,
+            drop_off_type INTEGER,
+            shape_dist_traveled REAL,
+            timepoint INTEGER,  -- Added column for timepoint
+            FOREIGN KEY (trip_id) REFERENCES trips (trip_id),
+            FOREIGN KEY (stop_id) REFERENCES stops (stop_id));
+        ''')
 
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS calendar (
@@ -108,13 +160,13 @@ def create_db_and_tables(db_name):
         FOREIGN KEY (service_id) REFERENCES calendar (service_id));
     ''')
 
-    cursor.execute('''
+    cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS shapes (
         shape_id TEXT,
-        shape_pt_lat TEXT,
-        shape_pt_lon TEXT,
+        shape_pt_lat {coordinate_type},
+        shape_pt_lon {coordinate_type},
         shape_pt_sequence INTEGER,
-        shape_dist_traveled TEXT);
+        shape_dist_traveled {coordinate_type});
     ''')
 
     cursor.execute('''
@@ -127,77 +179,370 @@ def create_db_and_tables(db_name):
         feed_version TEXT);
     ''')
 
-    # Commit changes
-    conn.commit()
-    return conn
-
-
-def load_gtfs_data(conn, zip_path):
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall("gtfs_data")
-
-    base_path = "gtfs_data/"
-    files = [
-        ("agency.txt", "agency"),
-        ("stops.txt", "stops"),
-        ("routes.txt", "routes"),
-        ("trips.txt", "trips"),
-        ("stop_times.txt", "stop_times"),
-        ("calendar.txt", "calendar"),
-        ("calendar_dates.txt", "calendar_dates"),
-        ("shapes.txt", "shapes"),
-        ("feed_info.txt", "feed_info")
-    ]
-
-    for file_name, table_name in files:
-        df = pd.read_csv(base_path + file_name)
-        df.to_sql(table_name, conn, if_exists='append', index=False)
-
-    # Clean up extracted files
-    for root, dirs, files in os.walk(base_path):
-        for file in files:
-            os.remove(os.path.join(root, file))
-    os.rmdir(base_path)
-
+    # CRC and size of each zip member as last loaded from each feed, used to skip unchanged tables
+    # on refresh. A table from before members were recorded per feed is dropped, which only costs
+    # one full reload.
+    cursor.execute("PRAGMA table_info(feed_members);")
+    member_columns = [col[1] for col in cursor.fetchall()]
+    if member_columns and "feed_path" not in member_columns:
+        cursor.execute("DROP TABLE feed_members;")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS feed_members (
+        feed_path TEXT,
+        file_name TEXT,
+        crc INTEGER,
+        file_size INTEGER,
+        loaded_at TEXT,
+        PRIMARY KEY (feed_path, file_name));
+    ''')
 
-from datetime import datetime, timedelta
-import sqlite3
+    # Materialised service calendar: the dates in the current window, which services run on
+    # each of them, and the trips that result
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS service_dates (
+        date TEXT PRIMARY KEY,
+        weekday INTEGER);
+    ''')
 
-def populate_temp_dates(conn):
-    cursor = conn.cursor()
-    # Change from TEMP TABLE to a regular table
-    cursor.execute("DROP TABLE IF EXISTS temp_dates;")
-    cursor.execute("CREATE TABLE IF NOT EXISTS temp_dates (date TEXT);")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS service_days (
+        service_id TEXT,
+        date TEXT,
+        PRIMARY KEY (service_id, date)) WITHOUT ROWID;
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_service_days_date ON service_days (date, service_id);")
 
-    for i in range(43):  # Today plus 42 days
-        date = (datetime.now() + timedelta(days=i)).strftime('%Y%m%d')  # Matches the GTFS date format
-        cursor.execute("INSERT INTO temp_dates (date) VALUES (?);", (date,))
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS active_trips (
+        service_date TEXT,
+        agency_id TEXT,
+        route_id TEXT,
+        trip_id TEXT,
+        PRIMARY KEY (service_date, trip_id)) WITHOUT ROWID;
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_active_trips_route ON active_trips (route_id, service_date);")
 
+    # Commit changes
     conn.commit()
+    return conn
 
-    # Diagnostic: Check the count of dates inserted
-    cursor.execute("SELECT COUNT(*) FROM temp_dates;")
-    count = cursor.fetchone()[0]
-    print(f"Inserted {count} rows into temp_dates.")
 
-    # Diagnostic: Sample some dates inserted into temp_dates
-    cursor.execute("SELECT date FROM temp_dates LIMIT 5;")
-    sample_dates = cursor.fetchall()
-    print("Sample dates in temp_dates:", sample_dates)
+# GTFS members loaded into the static database, in load order
+GTFS_FILES = [
+    ("agency.txt", "agency"),
+    ("stops.txt", "stops"),
+    ("routes.txt", "routes"),
+    ("trips.txt", "trips"),
+    ("stop_times.txt", "stop_times"),
+    ("calendar.txt", "calendar"),
+    ("calendar_dates.txt", "calendar_dates"),
+    ("shapes.txt", "shapes"),
+    ("feed_info.txt", "feed_info")
+]
+
+# Rows held in memory per insert batch - bounds peak memory regardless of feed size
+CHUNK_SIZE = 50000
+
+
+@contextmanager
+def bulk_load_settings(conn, relax_journal=True):
+    # Journal and sync are only relaxed for the duration of the load, as a failed
+    # load is simply re-run from the zip. The journal is left alone when refreshing a
+    # WAL database that readers may have open.
+    cursor = conn.cursor()
+    journal_mode = cursor.execute("PRAGMA journal_mode;").fetchone()[0]
+    synchronous = cursor.execute("PRAGMA synchronous;").fetchone()[0]
+
+    if relax_journal:
+        cursor.execute("PRAGMA journal_mode=MEMORY;")
+    cursor.execute("PRAGMA synchronous=OFF;")
+    cursor.execute("PRAGMA temp_store=MEMORY;")
+    cursor.execute("PRAGMA cache_size=-200000;")  # ~200MB page cache
+    try:
+        yield
+    finally:
+        if relax_journal:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode};")
+        cursor.execute(f"PRAGMA synchronous={synchronous};")
+
+
+def get_table_columns(conn, table_name):
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    return [col[1] for col in cursor.fetchall()]
+
+
+def is_compact(conn):
+    # Compact databases key stop_times by integer surrogates rather than trip_id/stop_id
+    return "trip_key" in get_table_columns(conn, "stop_times")
+
+
+# Text keys swapped for their surrogate key (key column, table holding it) on load into a compact stop_times
+COMPACT_KEY_COLUMNS = {
+    "trip_id": ("trip_key", "trips"),
+    "stop_id": ("stop_key", "stops"),
+}
+
+# Compact tables whose surrogate keys are referenced by other tables, which must be reloaded with them
+COMPACT_DEPENDENTS = {
+    "trips": ["stop_times"],
+    "stops": ["stop_times"],
+}
+
+# HH:MM:SS columns, converted to seconds when the schema declares them INTEGER
+GTFS_TIME_COLUMNS = ("arrival_time", "departure_time")
+
+
+def parse_gtfs_time(value):
+    # "25:10:00" -> 90600; GTFS times are relative to service-day midnight and can pass 24:00
+    if value is None:
+        return None
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def format_gtfs_time(seconds):
+    if seconds is None:
+        return None
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def iter_csv_chunks(zip_ref, file_name, chunk_size=CHUNK_SIZE):
+    # Read the member straight out of the archive, nothing is extracted to disk
+    with zip_ref.open(file_name) as raw:
+        reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        header = [name.strip() for name in next(reader, [])]
+        yield header, []
+
+        chunk = []
+        for row in reader:
+            if not row:
+                continue
+            # Empty strings become NULL, matching what pd.read_csv produced
+            chunk.append([value if value != '' else None for value in row])
+            if len(chunk) >= chunk_size:
+                yield header, chunk
+                chunk = []
+        if chunk:
+            yield header, chunk
+
+
+def build_insert(conn, file_name, table_name, header, key_tables=None):
+    # Map the file's header onto the table: returns the INSERT statement, the positions of the
+    # file columns it takes, and which of those positions hold times to convert to seconds.
+    # key_tables redirects surrogate key lookups, e.g. to a trips table that is being reloaded.
+    key_tables = key_tables or {}
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    column_types = {col[1]: col[2] for col in cursor.fetchall()}
+
+    positions, columns, values, time_positions, skipped = [], [], [], [], []
+    for i, name in enumerate(header):
+        if name in column_types:
+            columns.append(name)
+            values.append("?")
+            if name in GTFS_TIME_COLUMNS and column_types[name] == "INTEGER":
+                time_positions.append(len(positions))
+        elif name in COMPACT_KEY_COLUMNS and COMPACT_KEY_COLUMNS[name][0] in column_types:
+            key_column, key_table = COMPACT_KEY_COLUMNS[name]
+            columns.append(key_column)
+            values.append(f"(SELECT {key_column} FROM {key_tables.get(key_table, key_table)} WHERE {name} = ?)")
+        else:
+            skipped.append(name)
+            continue
+        positions.append(i)
+
+    if skipped:
+        print(f"{file_name}: ignoring columns not in {table_name}: {skipped}")
+    insert_sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(values)});"
+    return insert_sql, positions, time_positions
+
+
+def load_table(conn, zip_ref, file_name, table_name, chunk_size=CHUNK_SIZE, key_tables=None):
+    cursor = conn.cursor()
+    row_count = 0
+    insert_sql = None
+
+    for header, rows in iter_csv_chunks(zip_ref, file_name, chunk_size):
+        if insert_sql is None:
+            # Only load columns the schema knows about, in the order they appear in the file
+            insert_sql, positions, time_positions = build_insert(conn, file_name, table_name, header, key_tables)
+        if not rows:
+            continue
+
+        # Pick out the known columns, padding any short rows with NULLs
+        if len(positions) != len(header) or any(len(row) != len(header) for row in rows):
+            rows = [[row[i] if i < len(row) else None for i in positions] for row in rows]
+        if time_positions:
+            for row in rows:
+                for i in time_positions:
+                    row[i] = parse_gtfs_time(row[i])
+        cursor.executemany(insert_sql, rows)
+        row_count += len(rows)
+
+    return row_count
+
+
+def load_gtfs_data(conn, zip_path, chunk_size=CHUNK_SIZE):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref, bulk_load_settings(conn):
+        members = set(zip_ref.namelist())
+        cursor = conn.cursor()
+
+        # One transaction for the whole feed; foreign keys (if enabled) are checked at commit
+        cursor.execute("BEGIN;")
+        cursor.execute("PRAGMA defer_foreign_keys=ON;")
+        try:
+            for file_name, table_name in GTFS_FILES:
+                if file_name not in members:
+                    print(f"{file_name} not present in {zip_path}, skipping {table_name}.")
+                    continue
+
+                start = time.perf_counter()
+                row_count = load_table(conn, zip_ref, file_name, table_name, chunk_size)
+                elapsed = time.perf_counter() - start
+                rate = row_count / elapsed if elapsed > 0 else float('inf')
+                print(f"Loaded {row_count} rows into {table_name} in {elapsed:.2f}s ({rate:,.0f} rows/sec).")
+
+            record_loaded_members(conn, zip_ref, [table_name for _, table_name in GTFS_FILES])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# Tables feeding service_days/active_trips - a change to any of them needs a full service day rebuild
+SERVICE_TABLES = {"agency", "routes", "trips", "calendar", "calendar_dates"}
+
+
+def read_feed_version(zip_ref):
+    if "feed_info.txt" not in zip_ref.namelist():
+        return None
+    for header, rows in iter_csv_chunks(zip_ref, "feed_info.txt"):
+        if rows and "feed_version" in header:
+            return rows[0][header.index("feed_version")]
+    return None
+
+
+def record_loaded_members(conn, zip_ref, tables):
+    # Keyed by the feed's path, so feeds loaded into the same database don't overwrite each other
+    members = {info.filename: info for info in zip_ref.infolist()}
+    loaded_at = datetime.now().isoformat()
+    conn.cursor().executemany(
+        "INSERT OR REPLACE INTO feed_members (feed_path, file_name, crc, file_size, loaded_at) VALUES (?, ?, ?, ?, ?);",
+        [(zip_ref.filename, file_name, members[file_name].CRC, members[file_name].file_size, loaded_at)
+         for file_name, table_name in GTFS_FILES if table_name in tables and file_name in members])
+
+
+def get_loaded_members(conn, feed_path):
+    cursor = conn.cursor()
+    cursor.execute("SELECT file_name, crc, file_size FROM feed_members WHERE feed_path = ?;", (feed_path,))
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
 
 
-def create_day_specific_views(conn):
+def create_shadow_table(conn, table_name):
+    # Empty copy of a table's definition to load into while readers keep using the original
     cursor = conn.cursor()
+    shadow_name = f"{table_name}_new"
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;", (table_name,))
+    table_sql = cursor.fetchone()[0]
+    cursor.execute(f"DROP TABLE IF EXISTS {shadow_name};")
+    cursor.execute(re.sub(rf'^CREATE TABLE\s+"?{table_name}"?', f"CREATE TABLE {shadow_name}", table_sql))
+    return shadow_name
+
+
+def refresh_gtfs_data(conn, zip_path, chunk_size=CHUNK_SIZE):
+    # Reload only the members whose CRC/size in the zip's central directory differ from what was
+    # last loaded. Changed tables are loaded into shadow tables and swapped in with a single
+    # transaction, so WAL readers see either the old feed or the new one, never a mix.
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    compact = is_compact(conn)
+
+    # Each changed table is rebuilt from this zip alone, which would drop the rows of any other
+    # feed loaded into the same database (load_gtfs_data_parallel)
+    cursor.execute("SELECT DISTINCT feed_path FROM feed_members WHERE feed_path != ?;", (zip_path,))
+    other_feeds = [row[0] for row in cursor.fetchall()]
+    if other_feeds:
+        raise ValueError(f"Database also holds {other_feeds}; refreshing {zip_path} alone would drop their rows. "
+                         f"Rebuild it with load_gtfs_data_parallel instead.")
 
-    cursor.execute("SELECT date FROM temp_dates;")
-    dates = cursor.fetchall()
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        loaded = get_loaded_members(conn, zip_path)
+        cursor.execute("SELECT feed_version FROM feed_info LIMIT 1;")
+        current_version = cursor.fetchone()
+        new_version = read_feed_version(zip_ref)
+        print(f"Feed version: {current_version[0] if current_version else None} -> {new_version}")
+
+        members = {info.filename: info for info in zip_ref.infolist()}
+        changed = []
+        for file_name, table_name in GTFS_FILES:
+            info = members.get(file_name)
+            if info is None:
+                continue
+            if loaded.get(file_name) != (info.CRC, info.file_size):
+                changed.append(table_name)
+        if compact:
+            for table_name in list(changed):
+                changed.extend(dependent for dependent in COMPACT_DEPENDENTS.get(table_name, [])
+                               if dependent not in changed)
+
+        unchanged = [table_name for _, table_name in GTFS_FILES if table_name not in changed]
+        print(f"Unchanged tables: {unchanged}")
+        if not changed:
+            print("Feed unchanged, nothing to reload.")
+            return changed
+        print(f"Reloading tables: {changed}")
+
+        # Load the changed members into shadow tables
+        shadow_tables = {table_name: create_shadow_table(conn, table_name) for table_name in changed}
+        conn.commit()
+        with bulk_load_settings(conn, relax_journal=False):
+            cursor.execute("BEGIN;")
+            try:
+                for file_name, table_name in GTFS_FILES:
+                    if table_name not in shadow_tables:
+                        continue
+                    start = time.perf_counter()
+                    row_count = load_table(conn, zip_ref, file_name, shadow_tables[table_name], chunk_size,
+                                           key_tables=shadow_tables)
+                    elapsed = time.perf_counter() - start
+                    rate = row_count / elapsed if elapsed > 0 else float('inf')
+                    print(f"Loaded {row_count} rows into {shadow_tables[table_name]} in {elapsed:.2f}s ({rate:,.0f} rows/sec).")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                for shadow_name in shadow_tables.values():
+                    cursor.execute(f"DROP TABLE IF EXISTS {shadow_name};")
+                raise
+
+        # Swap the shadow tables in and rebuild their indexes in one transaction. Legacy rename
+        # stops SQLite validating views against the tables while they are briefly missing.
+        start = time.perf_counter()
+        cursor.execute("PRAGMA legacy_alter_table=ON;")
+        cursor.execute("BEGIN IMMEDIATE;")
+        try:
+            for table_name, shadow_name in shadow_tables.items():
+                cursor.execute(f"DROP TABLE {table_name};")
+                cursor.execute(f"ALTER TABLE {shadow_name} RENAME TO {table_name};")
+            create_indexes(conn, tables=changed)
+            record_loaded_members(conn, zip_ref, changed)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("PRAGMA legacy_alter_table=OFF;")
+        print(f"Swapped in {len(changed)} tables in {time.perf_counter() - start:.2f}s.")
+
+    cursor.execute("ANALYZE;")
+    conn.commit()
+    return changed
 
-    for date_tuple in dates:
-        date = date_tuple[0]
-        view_name = f"upcoming_trips_view_{date}"
 
-        cursor.execute(f'''
-        CREATE VIEW IF NOT EXISTS {view_name} AS
+def upcoming_trips_sql(date):
+    # Trips running on a given YYYYMMDD date, from the weekly calendar plus calendar_dates exceptions.
+    # The on-the-fly equivalent of active_trips, kept as the baseline for the standard query timings.
+    return f'''
         SELECT 
             '{date}' AS service_date,
             a.agency_id,
@@ -241,60 +586,299 @@ def create_day_specific_views(conn):
             agency a ON r.agency_id = a.agency_id
         WHERE 
             cd.exception_type = 1 AND
-            cd.date = '{date}';
-        ''')
-        print(f"Created view: {view_name}")
+            cd.date = '{date}'
+        '''
+
+
+# Days of service kept in service_days/active_trips: today plus 42 days
+SERVICE_WINDOW_DAYS = 43
 
-        # Diagnostic check for each view
-        cursor.execute(f"SELECT COUNT(*) FROM {view_name};")
-        view_count = cursor.fetchone()[0]
-        print(f"{view_name} has {view_count} rows.")
 
+def refresh_service_days(conn, start_date=None, days=SERVICE_WINDOW_DAYS, rebuild=False):
+    # Bring service_days and active_trips up to date for the window starting at start_date.
+    # Dates that have rolled out of the window are dropped and only dates new to the window
+    # are computed, unless rebuild is set (e.g. after the calendar has been reloaded).
+    cursor = conn.cursor()
+    start_date = start_date or datetime.now()
+    window = [(start_date + timedelta(days=i)) for i in range(days)]
+    first_date = window[0].strftime('%Y%m%d')
+    last_date = window[-1].strftime('%Y%m%d')
+
+    if rebuild:
+        cursor.execute("DELETE FROM service_dates;")
+        cursor.execute("DELETE FROM service_days;")
+        cursor.execute("DELETE FROM active_trips;")
+
+    # Drop dates outside the window
+    cursor.execute("DELETE FROM service_dates WHERE date < ? OR date > ?;", (first_date, last_date))
+    cursor.execute("DELETE FROM service_days WHERE date < ? OR date > ?;", (first_date, last_date))
+    removed = cursor.execute("DELETE FROM active_trips WHERE service_date < ? OR service_date > ?;",
+                             (first_date, last_date)).rowcount
+
+    cursor.execute("SELECT date FROM service_dates;")
+    known_dates = {row[0] for row in cursor.fetchall()}
+    new_dates = [(day.strftime('%Y%m%d'), day.weekday()) for day in window
+                 if day.strftime('%Y%m%d') not in known_dates]
+
+    cursor.execute("DROP TABLE IF EXISTS temp.new_dates;")
+    cursor.execute("CREATE TEMP TABLE new_dates (date TEXT PRIMARY KEY, weekday INTEGER);")
+    cursor.executemany("INSERT INTO new_dates (date, weekday) VALUES (?, ?);", new_dates)
+
+    # Weekly calendar, less removed dates, plus added dates - evaluated once per new date
+    cursor.execute('''
+    INSERT OR IGNORE INTO service_days (service_id, date)
+    SELECT c.service_id, d.date
+    FROM new_dates d
+    JOIN calendar c ON d.date BETWEEN c.start_date AND c.end_date
+    WHERE CASE d.weekday
+            WHEN 0 THEN c.monday
+            WHEN 1 THEN c.tuesday
+            WHEN 2 THEN c.wednesday
+            WHEN 3 THEN c.thursday
+            WHEN 4 THEN c.friday
+            WHEN 5 THEN c.saturday
+            WHEN 6 THEN c.sunday
+        END = 1
+    AND NOT EXISTS (
+        SELECT 1 FROM calendar_dates cd WHERE cd.service_id = c.service_id AND cd.date = d.date AND cd.exception_type = 2
+    )
+    UNION
+    SELECT cd.service_id, cd.date
+    FROM calendar_dates cd
+    JOIN new_dates d ON cd.date = d.date
+    WHERE cd.exception_type = 1;
+    ''')
+
+    added = cursor.execute('''
+    INSERT OR IGNORE INTO active_trips (service_date, agency_id, route_id, trip_id)
+    SELECT sd.date, a.agency_id, r.route_id, t.trip_id
+    FROM new_dates d
+    JOIN service_days sd ON sd.date = d.date
+    JOIN trips t ON t.service_id = sd.service_id
+    JOIN routes r ON t.route_id = r.route_id
+    JOIN agency a ON r.agency_id = a.agency_id;
+    ''').rowcount
+
+    cursor.execute("INSERT INTO service_dates (date, weekday) SELECT date, weekday FROM new_dates;")
+    cursor.execute("DROP TABLE temp.new_dates;")
+    cursor.execute("ANALYZE service_days;")
+    cursor.execute("ANALYZE active_trips;")
     conn.commit()
 
+    print(f"Service window {first_date}-{last_date}: computed {len(new_dates)} new dates, "
+          f"added {added} active trips, removed {removed} expired.")
 
-def generate_db_schema_json(conn, db_name, sample_size=5):
+
+def get_active_trips(conn, date):
+    # What runs on a given YYYYMMDD date - a primary key range lookup on active_trips
     cursor = conn.cursor()
-    cursor.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view');")
-    db_objects = cursor.fetchall()
+    cursor.execute("SELECT agency_id, route_id, trip_id FROM active_trips WHERE service_date = ?;", (date,))
+    return cursor.fetchall()
+
+
+# Secondary indexes on the access paths used by the views and trip/stop lookups
+INDEXES = [
+    ("idx_stop_times_trip_sequence", "stop_times", "trip_id, stop_sequence"),
+    ("idx_stop_times_stop", "stop_times", "stop_id, departure_time"),
+    ("idx_trips_service", "trips", "service_id"),
+    ("idx_trips_route", "trips", "route_id"),
+    ("idx_calendar_dates_service_date", "calendar_dates", "service_id, date"),
+    ("idx_calendar_dates_date", "calendar_dates", "date, exception_type"),
+    ("idx_shapes_shape_sequence", "shapes", "shape_id, shape_pt_sequence"),
+]
+
+# Compact stop_times is already clustered by (trip_key, stop_sequence); departure_time is an
+# integer so stop/time-window lookups are plain index range scans
+COMPACT_INDEXES = [
+    ("idx_stop_times_stop", "stop_times", "stop_key, departure_time"),
+] + [index for index in INDEXES if index[1] != "stop_times"]
+
+
+def get_standard_queries(conn):
+    # Representative lookups, parameterised with values taken from the loaded feed
+    cursor = conn.cursor()
+    trip_id = cursor.execute("SELECT trip_id FROM trips LIMIT 1;").fetchone()
+    stop_id = cursor.execute("SELECT stop_id FROM stops LIMIT 1;").fetchone()
+    shape_id = cursor.execute("SELECT shape_id FROM shapes LIMIT 1;").fetchone()
+    service_date = cursor.execute("SELECT service_id, date FROM calendar_dates LIMIT 1;").fetchone()
+    today = datetime.now().strftime('%Y%m%d')
+
+    queries = {"upcoming_trips": (upcoming_trips_sql(today), ())}
+    if is_compact(conn):
+        if trip_id:
+            queries["trip_stop_sequence"] = (
+                "SELECT stop_key, arrival_time, departure_time FROM stop_times "
+                "WHERE trip_key = (SELECT trip_key FROM trips WHERE trip_id = ?) ORDER BY stop_sequence;",
+                trip_id)
+        if stop_id:
+            queries["stop_trips"] = (
+                "SELECT trip_key, departure_time FROM stop_times "
+                "WHERE stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?) ORDER BY departure_time;",
+                stop_id)
+            queries["stop_departures_window"] = (
+                "SELECT trip_key, departure_time FROM stop_times "
+                "WHERE stop_key = (SELECT stop_key FROM stops WHERE stop_id = ?) "
+                "AND departure_time BETWEEN 28800 AND 32400;",
+                stop_id)
+    else:
+        if trip_id:
+            queries["trip_stop_sequence"] = (
+                "SELECT stop_id, arrival_time, departure_time FROM stop_times WHERE trip_id = ? ORDER BY stop_sequence;",
+                trip_id)
+        if stop_id:
+            queries["stop_trips"] = (
+                "SELECT trip_id, departure_time FROM stop_times WHERE stop_id = ? ORDER BY departure_time;",
+                stop_id)
+    if service_date:
+        queries["service_exceptions"] = (
+            "SELECT exception_type FROM calendar_dates WHERE service_id = ? AND date = ?;",
+            service_date)
+    if shape_id:
+        queries["shape_points"] = (
+            "SELECT shape_pt_lat, shape_pt_lon FROM shapes WHERE shape_id = ? ORDER BY shape_pt_sequence;",
+            shape_id)
+    return queries
+
+
+def time_standard_queries(conn, queries, repeat=3):
+    cursor = conn.cursor()
+    results = {}
+    for name, (sql, params) in queries.items():
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        plan = [row[3] for row in cursor.fetchall()]
+
+        # Best of several runs, fetching every row
+        best, _ = best_of(lambda: cursor.execute(sql, params).fetchall(), repeat)
+        results[name] = {"plan": plan, "seconds": best}
+    return results
+
+
+def create_indexes(conn, tables=None):
+    cursor = conn.cursor()
+    for index_name, table_name, columns in (COMPACT_INDEXES if is_compact(conn) else INDEXES):
+        if tables is not None and table_name not in tables:
+            continue
+        start = time.perf_counter()
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns});")
+        print(f"Built {index_name} on {table_name} ({columns}) in {time.perf_counter() - start:.2f}s.")
+
 
-    schema = {}
+def build_indexes(conn):
+    create_indexes(conn)
 
-    for obj_name, obj_type in db_objects:
-        cursor.execute(f"PRAGMA table_info({obj_name});")
-        columns_info = cursor.fetchall()
+    # Refresh planner statistics now the indexes exist
+    conn.cursor().execute("ANALYZE;")
+    conn.commit()
+
+
+def benchmark_indexes(conn):
+    # Builds the indexes like build_indexes, timing the standard queries before and after.
+    # Each query runs several times on the unindexed tables, so this is slow on a full feed.
+    queries = get_standard_queries(conn)
+    before = time_standard_queries(conn, queries)
+    build_indexes(conn)
+    after = time_standard_queries(conn, queries)
 
-        columns = [{"name": col[1], "type": col[2]} for col in columns_info]
+    print("Query timings before/after indexing:")
+    for name in queries:
+        print(f"  {name}: {before[name]['seconds'] * 1000:.2f}ms -> {after[name]['seconds'] * 1000:.2f}ms")
+        print(f"    before: {'; '.join(before[name]['plan'])}")
+        print(f"    after:  {'; '.join(after[name]['plan'])}")
+    return before, after
 
-        cursor.execute(f"SELECT * FROM {obj_name} LIMIT {sample_size};")
-        sample_data = cursor.fetchall()
 
-        schema[obj_name] = {
-            "type": obj_type,
-            "columns": columns,
-            "sample_data": sample_data
-        }
+def get_estimated_row_counts(conn):
+    # Row counts recorded by ANALYZE, so nothing is scanned. The first number in each
+    # sqlite_stat1 entry is the table's row count.
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1';")
+    if cursor.fetchone() is None:
+        return {}
+    cursor.execute("SELECT tbl, stat FROM sqlite_stat1;")
+    return {table_name: int(stat.split()[0]) for table_name, stat in cursor.fetchall()}
+
+
+def generate_db_schema_json(conn, db_name, sample_size=5, sample_views=False):
+    # Columns come from PRAGMA and row counts from sqlite_stat1; only base tables are sampled
+    # unless sample_views is set, as selecting from a view runs its query. Each object is
+    # written as soon as it is read.
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, type, sql FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%';")
+    db_objects = cursor.fetchall()
+    # Leave out the internal storage tables behind virtual tables such as the R*Tree indexes
+    virtual_tables = [name for name, _, sql in db_objects if sql.upper().startswith("CREATE VIRTUAL TABLE")]
+    db_objects = [(name, obj_type) for name, obj_type, _ in db_objects
+                  if not any(name.startswith(f"{virtual_table}_") for virtual_table in virtual_tables)]
+    row_counts = get_estimated_row_counts(conn)
 
     with open(f'{db_name}_schema.json', 'w') as f:
-        json.dump(schema, f, indent=4)
+        f.write("{")
+        for i, (obj_name, obj_type) in enumerate(db_objects):
+            cursor.execute(f"PRAGMA table_info({obj_name});")
+            columns_info = cursor.fetchall()
+
+            columns = [{"name": col[1], "type": col[2]} for col in columns_info]
+
+            sample_data = None
+            if obj_type == 'table' or sample_views:
+                cursor.execute(f"SELECT * FROM {obj_name} LIMIT {sample_size};")
+                sample_data = cursor.fetchall()
+
+            entry = {
+                "type": obj_type,
+                "columns": columns,
+                "estimated_rows": row_counts.get(obj_name),
+                "sample_data": sample_data
+            }
+            body = json.dumps(entry, indent=4).replace("\n", "\n    ")
+            f.write(f"{',' if i else ''}\n    {json.dumps(obj_name)}: {body}")
+            f.flush()
+        f.write("\n}")
 
     print("Database schema JSON has been generated.")
 
 
-def main(zip_path):
+def main(zip_path, compact=False, db_name=None, benchmark=False):
+    # With a db_name the database is kept and refreshed in place, reloading only what changed;
+    # otherwise a new timestamped database is built from scratch, timing the standard queries
+    # before and after indexing if benchmark is set
+    if db_name:
+        conn = create_db_and_tables(db_name, compact=compact)
+        changed = refresh_gtfs_data(conn, zip_path)
+        spatial_tables = [table_name for table_name in ("stops", "shapes") if table_name in changed]
+        if spatial_tables:
+            build_spatial_index(conn, tables=spatial_tables)
+        # Services and trips running today plus the next 42 days, recomputed in full if the calendar changed
+        refresh_service_days(conn, rebuild=bool(SERVICE_TABLES.intersection(changed)))
+        generate_db_schema_json(conn, db_name)
+        conn.close()
+        print(f"Database {db_name} refreshed from {zip_path}.")
+        return
+
     db_name = f"gtfs_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    conn = create_db_and_tables(db_name)
+    conn = create_db_and_tables(db_name, compact=compact)
     load_gtfs_data(conn, zip_path)
-    populate_temp_dates(conn)  # Populate temporary table with the next 42 days
-    create_day_specific_views(conn)  # Create the view considering both regular schedules and exceptions
+    # Secondary indexes and planner statistics for the loaded data
+    if benchmark:
+        benchmark_indexes(conn)
+    else:
+        build_indexes(conn)
+    build_spatial_index(conn)  # R*Tree indexes for nearest-stop and shape lookups
+    refresh_service_days(conn)  # Services and trips running today plus the next 42 days, considering exceptions
 
     # Generate the JSON schema file
     generate_db_schema_json(conn, db_name)
 
     conn.close()
-    print(f"Database {db_name} created successfully with GTFS data and specialized view and schema JSON.")
+    print(f"Database {db_name} created successfully with GTFS data, service days and schema JSON.")
 
 
 if __name__ == "__main__":
-    zip_path = 'gtfs_files/itm_east_anglia_gtfs.zip'
-    main(zip_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load a static GTFS zip into SQLite")
+    parser.add_argument('zip_path', nargs='?', default='gtfs_files/itm_east_anglia_gtfs.zip')
+    parser.add_argument('--compact', action='store_true', help="integer times and surrogate keys in stop_times")
+    parser.add_argument('--db-name', help="refresh this database in place instead of building a new one")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="time the standard queries before and after indexing (slow on large feeds)")
+    args = parser.parse_args()
+    main(args.zip_path, args.compact, args.db_name, args.benchmark)
\ No newline at end of file
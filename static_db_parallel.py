@@ -0,0 +1,235 @@
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from static_db_load import (GTFS_FILES, create_db_and_tables, load_gtfs_data, bulk_load_settings, build_insert,
+                            record_loaded_members, parse_gtfs_time)
+
+# Members large enough to be split into byte ranges and parsed by several workers. A range is
+# cut at a line break outside quotes; trips.txt can have quoted newlines in trip_headsign.
+SPLIT_TABLES = ("trips", "stop_times", "shapes")
+
+# Uncompressed bytes parsed per worker task
+RANGE_BYTES = 16 * 1024 * 1024
+
+# Parsed tasks waiting for the writer, per worker - bounds memory if the writer falls behind
+IN_FLIGHT_PER_WORKER = 2
+
+
+def to_number(value, number_type):
+    # Tolerant conversion, leaving anything unparseable for SQLite's column affinity to deal with
+    if value is None:
+        return None
+    try:
+        return number_type(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+CONVERTERS = {
+    "time": parse_gtfs_time,
+    "INTEGER": lambda value: to_number(value, int),
+    "REAL": lambda value: to_number(value, float),
+}
+
+
+def plan_table(conn, file_name, table_name, header):
+    # Resolve the insert statement in the writer, and the per-column conversions the workers apply
+    insert_sql, positions, time_positions = build_insert(conn, file_name, table_name, header)
+
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table_name});")
+    column_types = {col[1]: col[2] for col in cursor.fetchall()}
+
+    converters = []
+    for position, i in enumerate(positions):
+        name = header[i]
+        if position in time_positions:
+            converters.append("time")
+        elif column_types.get(name) in CONVERTERS:
+            converters.append(column_types[name])
+        else:
+            converters.append(None)  # Text, or a text id resolved to a surrogate key by the INSERT
+    return insert_sql, positions, converters
+
+
+def iter_member_blocks(zip_ref, file_name, table_name, range_bytes=RANGE_BYTES):
+    # Decompress a member sequentially and cut it into byte ranges ending on a line break.
+    # Members not in SPLIT_TABLES come back whole. Each range starts on a row, so the line
+    # break is outside quotes when the range has an even number of quote characters up to it
+    # (an escaped quote is two); if not, the rest of the member is parsed as one block.
+    with zip_ref.open(file_name) as raw:
+        header_line = raw.readline()
+        header = [name.strip() for name in next(csv.reader([header_line.decode('utf-8-sig')]), [])]
+        yield header, None
+
+        if table_name not in SPLIT_TABLES:
+            yield header, raw.read()
+            return
+
+        carry = b''
+        while True:
+            data = raw.read(range_bytes)
+            if not data:
+                break
+            block = carry + data
+            cut = block.rfind(b'\n') + 1
+            if block.count(b'"', 0, cut) % 2:
+                yield header, block + raw.read()
+                return
+            if cut == 0:
+                carry = block
+                continue
+            carry = block[cut:]
+            yield header, block[:cut]
+        if carry:
+            yield header, carry
+
+
+def parse_block(table_name, block, positions, converters):
+    # Worker: parse and type-convert the rows in one block of a member
+    rows = []
+    width = len(positions)
+    functions = [CONVERTERS.get(converter) for converter in converters]
+    for row in csv.reader(io.StringIO(block.decode('utf-8'))):
+        if not row:
+            continue
+        values = [row[i] if i < len(row) and row[i] != '' else None for i in positions]
+        for j in range(width):
+            if functions[j] is not None and values[j] is not None:
+                values[j] = functions[j](values[j])
+        rows.append(values)
+    return table_name, rows
+
+
+def iter_tasks(conn, zip_refs, insert_sql):
+    # Blocks for every feed, table by table in GTFS_FILES order so a table's dependencies are
+    # always read first, and feed by feed within a table in the order the zips were given
+    for file_name, table_name in GTFS_FILES:
+        for zip_path, zip_ref in zip_refs.items():
+            if file_name not in zip_ref.namelist():
+                print(f"{file_name} not present in {zip_path}, skipping {table_name}.")
+                continue
+            for header, block in iter_member_blocks(zip_ref, file_name, table_name):
+                if block is None:
+                    sql, positions, converters = plan_table(conn, file_name, table_name, header)
+                    if len(zip_refs) > 1:
+                        # Neighbouring regional feeds share agencies and stops; keep the copy
+                        # from the first feed given
+                        sql = sql.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+                    insert_sql[(zip_path, table_name)] = sql
+                    continue
+                yield zip_path, (table_name, block, positions, converters)
+
+
+def load_gtfs_data_parallel(conn, zip_paths, workers=None):
+    # Parse every member of every feed across a process pool; this process reads the zips
+    # and is the single writer
+    workers = workers or os.cpu_count()
+    if isinstance(zip_paths, str):
+        zip_paths = [zip_paths]
+    load_start = time.perf_counter()
+
+    insert_sql = {}
+    row_counts = {table_name: 0 for _, table_name in GTFS_FILES}  # Rows actually inserted
+    parsed_counts = {table_name: 0 for _, table_name in GTFS_FILES}
+    write_seconds = {table_name: 0.0 for _, table_name in GTFS_FILES}
+
+    zip_refs = {zip_path: zipfile.ZipFile(zip_path, 'r') for zip_path in zip_paths}
+    tasks = enumerate(iter_tasks(conn, zip_refs, insert_sql))
+    cursor = conn.cursor()
+    with ProcessPoolExecutor(max_workers=workers) as pool, bulk_load_settings(conn):
+        cursor.execute("BEGIN;")
+        cursor.execute("PRAGMA defer_foreign_keys=ON;")
+        try:
+            pending = {}
+            parsed = {}  # Finished blocks by read order, waiting for the ones before them
+            next_write = 0
+            exhausted = False
+            while not exhausted or pending or parsed:
+                while not exhausted and len(pending) + len(parsed) < workers * IN_FLIGHT_PER_WORKER:
+                    item = next(tasks, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        sequence, (zip_path, task) = item
+                        pending[pool.submit(parse_block, *task)] = (sequence, zip_path)
+
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        sequence, zip_path = pending.pop(future)
+                        parsed[sequence] = (zip_path, *future.result())
+
+                # Blocks are written in the order they were read, however the workers finish:
+                # a table's dependencies (the trip/stop keys compact stop_times looks up) are
+                # always in first, and INSERT OR IGNORE always keeps the same feed's copy
+                while next_write in parsed:
+                    zip_path, table_name, rows = parsed.pop(next_write)
+                    next_write += 1
+                    start = time.perf_counter()
+                    cursor.executemany(insert_sql[(zip_path, table_name)], rows)
+                    write_seconds[table_name] += time.perf_counter() - start
+                    # rowcount leaves out rows INSERT OR IGNORE skipped as already loaded from another feed
+                    row_counts[table_name] += cursor.rowcount
+                    parsed_counts[table_name] += len(rows)
+
+            for zip_ref in zip_refs.values():
+                record_loaded_members(conn, zip_ref, [table_name for _, table_name in GTFS_FILES])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            for zip_ref in zip_refs.values():
+                zip_ref.close()
+
+    elapsed = time.perf_counter() - load_start
+    for table_name, row_count in row_counts.items():
+        duplicates = parsed_counts[table_name] - row_count
+        print(f"Loaded {row_count} rows into {table_name} ({write_seconds[table_name]:.2f}s writing)"
+              + (f", ignored {duplicates} duplicates." if duplicates else "."))
+    total_rows = sum(row_counts.values())
+    print(f"Loaded {total_rows} rows from {len(zip_paths)} feeds with {workers} workers in {elapsed:.2f}s "
+          f"({total_rows / elapsed:,.0f} rows/sec).")
+    return row_counts
+
+
+def benchmark(zip_paths, worker_counts=None, compact=False):
+    # Wall-clock load of the same feeds: the sequential loader against the pool at each worker count
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count()})
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The sequential loader builds one database per feed
+        start = time.perf_counter()
+        for i, zip_path in enumerate(zip_paths):
+            conn = create_db_and_tables(os.path.join(tmp_dir, f"sequential_{i}.db"), compact=compact)
+            load_gtfs_data(conn, zip_path)
+            conn.close()
+        results["sequential"] = time.perf_counter() - start
+
+        for workers in worker_counts:
+            db_name = os.path.join(tmp_dir, f"parallel_{workers}.db")
+            conn = create_db_and_tables(db_name, compact=compact)
+            start = time.perf_counter()
+            load_gtfs_data_parallel(conn, zip_paths, workers=workers)
+            results[f"{workers} workers"] = time.perf_counter() - start
+            conn.close()
+
+    print("Load benchmark:")
+    for name, seconds in results.items():
+        print(f"  {name}: {seconds:.2f}s ({results['sequential'] / seconds:.2f}x sequential)")
+    return results
+
+
+if __name__ == "__main__":
+    zip_paths = sys.argv[1:] or ['gtfs_files/itm_east_anglia_gtfs.zip']
+    benchmark(zip_paths)
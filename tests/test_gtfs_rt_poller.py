@@ -0,0 +1,132 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+import gtfs_realtime_pb2
+from gtfs_rt_poller import create_session, run_poller
+
+
+def make_feed(timestamp, vehicles=3):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = timestamp
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        entity.vehicle.vehicle.id = str(i)
+        entity.vehicle.timestamp = timestamp - i
+    return feed.SerializeToString()
+
+
+@pytest.fixture
+def stub_server():
+    # Local feed server answering each request with the next scripted (status, body, etag), the
+    # last one repeating, and with 304 when If-None-Match matches. Request headers are recorded.
+    responses = []
+    seen = []
+
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append(dict(self.headers))
+            status, body, etag = responses.pop(0) if len(responses) > 1 else responses[0]
+            if etag and self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+            self.send_response(status)
+            if etag:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/feed", responses, seen
+    server.shutdown()
+    server.server_close()
+
+
+def poll(url, polls, session=None):
+    handled = []
+    state = run_poller(url, handle_feed=handled.append, session=session or create_session(backoff_factor=0),
+                       max_polls=polls, sleep=lambda seconds: None)
+    return state, handled
+
+
+def test_etag_not_modified(stub_server):
+    url, responses, seen = stub_server
+    feed = make_feed(1000)
+    responses.append((200, feed, '"v1"'))
+    state, handled = poll(url, 3)
+    assert handled == [feed]
+    assert state["processed"] == 1
+    assert state["not_modified"] == 2
+    assert 'If-None-Match' not in seen[0]
+    assert all(headers['If-None-Match'] == '"v1"' for headers in seen[1:])
+
+
+def test_unchanged_content_is_not_handled_again(stub_server):
+    url, responses, _ = stub_server
+    feed = make_feed(1000)
+    responses.append((200, feed, None))
+    state, handled = poll(url, 3)
+    assert handled == [feed]
+    assert state["unchanged"] == 2
+
+
+def test_stale_header_timestamp_is_skipped(stub_server):
+    url, responses, _ = stub_server
+    first, stale, newer = make_feed(1000), make_feed(900), make_feed(1100)
+    responses.extend([(200, first, None), (200, stale, None), (200, newer, None)])
+    state, handled = poll(url, 3)
+    assert handled == [first, newer]
+    assert state["stale"] == 1
+    assert state["feed_timestamp"] == 1100
+
+
+def test_headerless_body_is_skipped(stub_server):
+    url, responses, _ = stub_server
+    headerless = gtfs_realtime_pb2.FeedMessage()
+    headerless.entity.add(id="1").vehicle.vehicle.id = "1"
+    feed = make_feed(1000)
+    responses.extend([(200, headerless.SerializePartialToString(), None), (200, feed, None)])
+    state, handled = poll(url, 2)
+    assert handled == [feed]
+    assert state["invalid"] == 1
+
+
+def test_gateway_error_is_retried(stub_server):
+    url, responses, seen = stub_server
+    feed = make_feed(1000)
+    responses.extend([(503, b'', None), (200, feed, None)])
+    state, handled = poll(url, 1)
+    assert handled == [feed]
+    assert len(seen) == 2
+    assert state["failed"] == 0
+
+
+def test_persistent_gateway_error_backs_off_then_fails(stub_server):
+    url, responses, seen = stub_server
+    responses.append((503, b'', None))
+    start = time.perf_counter()
+    state, handled = poll(url, 1, create_session(retries=2, backoff_factor=0.1))
+    assert handled == []
+    assert len(seen) == 3
+    assert state["failed"] == 1
+    # Backoff before the second retry is backoff_factor * 2
+    assert time.perf_counter() - start >= 0.15
+
+
+def test_server_error_counts_as_failed_poll(stub_server):
+    url, responses, seen = stub_server
+    feed = make_feed(1000)
+    responses.extend([(500, b'', None), (200, feed, None)])
+    state, handled = poll(url, 2)
+    assert handled == [feed]
+    assert len(seen) == 2  # 500 is not retried
+    assert state["failed"] == 1
+    assert state["processed"] == 1
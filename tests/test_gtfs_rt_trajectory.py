@@ -0,0 +1,56 @@
+import time
+
+import gtfs_realtime_pb2
+from gtfs_rt_flatten import VEHICLE_POSITION_FLATTENER
+from gtfs_rt_trajectory import create_trajectory_db, make_trajectory_handler, simulate_day, vehicle_trajectory
+
+
+def make_feed(timestamp, vehicles=100):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = timestamp
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        entity.vehicle.vehicle.id = f"{i:04d}"
+        entity.vehicle.trip.trip_id = f"T{i}"
+        entity.vehicle.trip.route_id = str(i % 7)
+        entity.vehicle.position.latitude = 53.0 + i / 1000
+        entity.vehicle.position.longitude = -1.0
+        entity.vehicle.timestamp = timestamp - i
+    return feed.SerializeToString()
+
+
+def count_positions(db_name):
+    conn = create_trajectory_db(db_name)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM positions;').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_handler_stores_flattened_feed(tmp_path):
+    db_name = str(tmp_path / 'trajectories.db')
+    handle_feed = make_trajectory_handler(db_name)
+    # Recent enough to survive the compaction run on the first poll
+    now = int(time.time())
+    handle_feed(make_feed(now))
+    assert count_positions(db_name) == 100
+
+    # The same observations again are ignored; a later poll adds one position per vehicle
+    handle_feed(make_feed(now))
+    assert count_positions(db_name) == 100
+    handle_feed(make_feed(now + 30))
+    assert count_positions(db_name) == 200
+
+    conn = create_trajectory_db(db_name)
+    trajectory = vehicle_trajectory(conn, '0005')
+    conn.close()
+    assert trajectory['timestamp'].tolist() == [now - 5, now + 25]
+    assert trajectory['route_id'].tolist() == ['5', '5']
+
+
+def test_simulated_polls_have_flattened_columns():
+    df = next(simulate_day(vehicles=10, positions_per_day=100))
+    assert list(df.columns) == [name for name, _, _ in VEHICLE_POSITION_FLATTENER[0]]
+    assert (df['vehicle_id'] != '').all()
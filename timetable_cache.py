@@ -0,0 +1,246 @@
+import json
+import mmap
+import random
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+from static_db_load import is_compact, parse_gtfs_time
+
+# File layout: MAGIC, 8-byte header length, JSON header describing each array (dtype, shape,
+# offset), then the raw arrays, each aligned to ALIGNMENT bytes so they can be mapped in place
+MAGIC = b'GTFSTT01'
+ALIGNMENT = 64
+
+# Stands in for a missing arrival/departure time (allowed for non-timepoint stops)
+NO_TIME = -1
+
+
+def stop_times_source_sql(conn):
+    # stop_times with text ids in either schema; times are HH:MM:SS text or integer seconds
+    if is_compact(conn):
+        return '''
+        SELECT t.trip_id, s.stop_id, st.stop_sequence, st.arrival_time, st.departure_time
+        FROM stop_times st
+        JOIN trips t ON t.trip_key = st.trip_key
+        JOIN stops s ON s.stop_key = st.stop_key
+        '''
+    return "SELECT trip_id, stop_id, stop_sequence, arrival_time, departure_time FROM stop_times"
+
+
+def to_seconds(value):
+    if value is None:
+        return NO_TIME
+    if isinstance(value, str):
+        return parse_gtfs_time(value)
+    return int(value)
+
+
+def sorted_ids(values):
+    # Ids are held sorted so id -> index is a binary search over the mapped array
+    return np.array(sorted(values), dtype=bytes)
+
+
+def compile_timetable(conn, path):
+    # Build the timetable artifact: trips, stops and routes as sorted id arrays, stop_times as
+    # CSR arrays per trip (trip_offsets into stop/arrival/departure) and, per stop, the
+    # stop_times rows at that stop ordered by departure (stop_offsets into stop_events)
+    start = time.perf_counter()
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT route_id, route_short_name FROM routes;")
+    route_names = dict(cursor.fetchall())
+    route_ids = sorted_ids(route_id.encode() for route_id in route_names)
+    route_short_names = np.array([(route_names[route_id.decode()] or '').encode() for route_id in route_ids],
+                                 dtype=bytes)
+
+    cursor.execute("SELECT trip_id, route_id, service_id FROM trips;")
+    trip_rows = {trip_id: (route_id, service_id) for trip_id, route_id, service_id in cursor.fetchall()}
+    trip_ids = sorted_ids(trip_id.encode() for trip_id in trip_rows)
+    service_ids = sorted_ids({service_id.encode() for _, service_id in trip_rows.values() if service_id})
+    trip_index = {trip_id.decode(): i for i, trip_id in enumerate(trip_ids)}
+    route_index = {route_id.decode(): i for i, route_id in enumerate(route_ids)}
+    service_index = {service_id.decode(): i for i, service_id in enumerate(service_ids)}
+    trip_route = np.array([route_index.get(trip_rows[trip_id.decode()][0], -1) for trip_id in trip_ids], dtype=np.int32)
+    trip_service = np.array([service_index.get(trip_rows[trip_id.decode()][1], -1) for trip_id in trip_ids],
+                            dtype=np.int32)
+
+    cursor.execute("SELECT stop_id FROM stops;")
+    stop_ids = sorted_ids(row[0].encode() for row in cursor.fetchall())
+    stop_index = {stop_id.decode(): i for i, stop_id in enumerate(stop_ids)}
+
+    cursor.execute("SELECT COUNT(*) FROM stop_times;")
+    count = cursor.fetchone()[0]
+    st_trip = np.empty(count, dtype=np.int32)
+    st_stop = np.empty(count, dtype=np.int32)
+    st_sequence = np.empty(count, dtype=np.int32)
+    st_arrival = np.empty(count, dtype=np.int32)
+    st_departure = np.empty(count, dtype=np.int32)
+
+    cursor.execute(stop_times_source_sql(conn))
+    n = 0
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        for trip_id, stop_id, stop_sequence, arrival_time, departure_time in rows:
+            trip = trip_index.get(trip_id)
+            if trip is None:
+                continue  # stop_times row for a trip not in trips.txt
+            st_trip[n] = trip
+            st_stop[n] = stop_index.get(stop_id, -1)
+            st_sequence[n] = stop_sequence
+            st_arrival[n] = to_seconds(arrival_time)
+            st_departure[n] = to_seconds(departure_time)
+            n += 1
+    st_trip, st_stop, st_sequence = st_trip[:n], st_stop[:n], st_sequence[:n]
+    st_arrival, st_departure = st_arrival[:n], st_departure[:n]
+
+    # CSR by trip: rows ordered by (trip, stop_sequence)
+    order = np.lexsort((st_sequence, st_trip))
+    st_trip, st_stop, st_sequence = st_trip[order], st_stop[order], st_sequence[order]
+    st_arrival, st_departure = st_arrival[order], st_departure[order]
+    trip_offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(st_trip, minlength=len(trip_ids)), out=trip_offsets[1:])
+
+    # CSR by stop: row numbers ordered by (stop, departure)
+    known_stop = st_stop >= 0
+    stop_events = np.flatnonzero(known_stop)
+    stop_events = stop_events[np.lexsort((st_departure[stop_events], st_stop[stop_events]))].astype(np.int64)
+    stop_offsets = np.zeros(len(stop_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(st_stop[known_stop], minlength=len(stop_ids)), out=stop_offsets[1:])
+
+    arrays = {
+        "route_ids": route_ids,
+        "route_short_names": route_short_names,
+        "service_ids": service_ids,
+        "trip_ids": trip_ids,
+        "trip_route": trip_route,
+        "trip_service": trip_service,
+        "trip_offsets": trip_offsets,
+        "stop_ids": stop_ids,
+        "stop_offsets": stop_offsets,
+        "stop_events": stop_events,
+        "st_trip": st_trip,
+        "st_stop": st_stop,
+        "st_sequence": st_sequence,
+        "st_arrival": st_arrival,
+        "st_departure": st_departure,
+    }
+    write_arrays(path, arrays)
+    print(f"Compiled timetable of {len(trip_ids)} trips, {len(stop_ids)} stops and {n} stop times "
+          f"to {path} in {time.perf_counter() - start:.2f}s.")
+
+
+def write_arrays(path, arrays):
+    header = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        header[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+
+
+def load_timetable(path):
+    # Map the artifact and return its arrays as read-only views onto the mapping - nothing is
+    # copied or parsed beyond the small JSON header
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a compiled timetable.")
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    timetable = {}
+    for name, spec in header.items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        timetable[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                        offset=data_start + spec["offset"]).reshape(spec["shape"])
+    return timetable
+
+
+def find_index(ids, value):
+    # Position of an id in one of the sorted id arrays, or None. An id longer than the array's
+    # fixed width can't be in it, and casting it to that width would truncate it onto another id.
+    encoded = value.encode()
+    if len(encoded) > ids.dtype.itemsize:
+        return None
+    key = np.array(encoded, dtype=ids.dtype)
+    i = int(np.searchsorted(ids, key))
+    if i < len(ids) and ids[i] == key:
+        return i
+    return None
+
+
+def find_indexes(ids, values):
+    # find_index for many ids at once: positions in the sorted id array, -1 where absent
+    keys = np.array([value.encode() for value in values], dtype=bytes)
+    if not len(ids) or not len(keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(ids, keys), len(ids) - 1)
+    return np.where(ids[positions] == keys, positions, -1)
+
+
+def trip_stop_times(timetable, trip_id):
+    # (stop indexes, arrival seconds, departure seconds) for a trip in stop_sequence order, as views
+    trip = find_index(timetable["trip_ids"], trip_id)
+    if trip is None:
+        return None
+    start, end = timetable["trip_offsets"][trip], timetable["trip_offsets"][trip + 1]
+    return timetable["st_stop"][start:end], timetable["st_arrival"][start:end], timetable["st_departure"][start:end]
+
+
+def stop_departures(timetable, stop_id):
+    # (trip indexes, departure seconds) of every stop time at a stop, ordered by departure
+    stop = find_index(timetable["stop_ids"], stop_id)
+    if stop is None:
+        return None
+    events = timetable["stop_events"][timetable["stop_offsets"][stop]:timetable["stop_offsets"][stop + 1]]
+    return timetable["st_trip"][events], timetable["st_departure"][events]
+
+
+def decode_ids(ids, indexes):
+    return [ids[i].decode() for i in indexes]
+
+
+def benchmark(path, lookups=10000):
+    start = time.perf_counter()
+    timetable = load_timetable(path)
+    print(f"Opened {path} in {(time.perf_counter() - start) * 1e3:.2f}ms.")
+
+    trip_ids = random.choices(decode_ids(timetable["trip_ids"], range(len(timetable["trip_ids"]))), k=lookups)
+    stop_ids = random.choices(decode_ids(timetable["stop_ids"], range(len(timetable["stop_ids"]))), k=lookups)
+
+    start = time.perf_counter()
+    for trip_id in trip_ids:
+        trip_stop_times(timetable, trip_id)
+    print(f"trip -> stop times: {(time.perf_counter() - start) / lookups * 1e6:.1f}us per lookup.")
+
+    start = time.perf_counter()
+    for stop_id in stop_ids:
+        stop_departures(timetable, stop_id)
+    print(f"stop -> trips: {(time.perf_counter() - start) / lookups * 1e6:.1f}us per lookup.")
+
+
+if __name__ == "__main__":
+    db_name = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else f"{db_name}.timetable"
+    conn = sqlite3.connect(db_name)
+    compile_timetable(conn, path)
+    conn.close()
+    benchmark(path)